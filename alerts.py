@@ -0,0 +1,166 @@
+import os
+import time
+import atexit
+import threading
+from collections import OrderedDict, deque
+from . import logutils
+from . import utils
+
+logger = logutils.get_logger('leek-alerts')
+
+
+class AirbrakeBackend(object):
+    def __init__(self):
+        self.notifier = None
+
+    def send(self, error, params):
+        # 第一次发送时才创建, 避免 import 时就需要 airbrake 配置
+        if self.notifier is None:
+            self.notifier = utils.get_airbrake_notifier()
+        notice = self.notifier.build_notice(error)
+        notice['params'].update(params)
+        self.notifier.send_notice(notice)
+
+
+# 本地运行或测试时代替 airbrake
+class LogBackend(object):
+    def send(self, error, params):
+        logger.warning("alert %s %s", error, params)
+
+
+class MemoryBackend(object):
+    def __init__(self):
+        self.notices = []
+
+    def send(self, error, params):
+        self.notices.append((error, params))
+
+
+# supervisor 的子进程把提醒转发给主进程, 由主进程统一去重限速后发送
+class QueueBackend(object):
+    def __init__(self, queue):
+        self.queue = queue
+
+    def send(self, error, params):
+        # 异常对象不一定能跨进程传递, 只传字符串
+        self.queue.put((str(error), params))
+
+
+BACKENDS = {
+    'airbrake': AirbrakeBackend,
+    'log': LogBackend,
+    'memory': MemoryBackend,
+}
+
+
+# 事件循环只负责入队, 后台线程发送
+# 同一个 key 在 dedup_interval 秒内只发送一次, 期间重复的提醒合并计数; 每分钟最多发送 rate_limit 条; 队列最多 max_size 个 key
+class AlertNotifier(object):
+    def __init__(self, backend, max_size=1000, dedup_interval=600, rate_limit=30):
+        self.backend = backend
+        self.max_size = max_size
+        self.dedup_interval = dedup_interval
+        self.rate_limit = rate_limit
+        self.pending = OrderedDict()
+        # 按发送时间排序, 超过 dedup_interval 的已不影响去重, 发送时从头部删除
+        self.sent_at = OrderedDict()
+        self.send_times = deque()
+        self.cond = threading.Condition()
+        self.thread = None
+        self.stopped = False
+        self.sent_count = 0
+        self.coalesced_count = 0
+        self.dropped_count = 0
+
+    def notify(self, error, params=None, key=None):
+        params = params or {}
+        if key is None:
+            key = (params.get('name'), str(error))
+        with self.cond:
+            if key in self.pending:
+                self.pending[key][2] += 1
+                self.coalesced_count += 1
+                return
+            if len(self.pending) >= self.max_size:
+                self.dropped_count += 1
+                return
+            self.pending[key] = [error, params, 1]
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='leek-alerts', daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def _next_item(self):
+        # 返回 (key, 还需等待的秒数)
+        now = time.time()
+        while self.send_times and now - self.send_times[0] >= 60:
+            self.send_times.popleft()
+        rate_wait = 60 - (now - self.send_times[0]) if len(self.send_times) >= self.rate_limit else 0
+        best_key = None
+        best_wait = None
+        for key in self.pending:
+            wait = max(self.sent_at.get(key, 0) + self.dedup_interval - now, rate_wait)
+            if best_wait is None or wait < best_wait:
+                best_key = key
+                best_wait = wait
+                if wait <= 0:
+                    break
+        return best_key, best_wait
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if not self.pending:
+                        if self.stopped:
+                            return
+                        self.cond.wait()
+                        continue
+                    key, wait = self._next_item()
+                    if wait <= 0 or self.stopped:
+                        break
+                    self.cond.wait(wait)
+                error, params, count = self.pending.pop(key)
+                now = time.time()
+                self.sent_at.pop(key, None)
+                self.sent_at[key] = now
+                while self.sent_at and now - next(iter(self.sent_at.values())) >= self.dedup_interval:
+                    self.sent_at.popitem(last=False)
+                self.send_times.append(now)
+            if count > 1:
+                params = dict(params, count=count)
+            try:
+                self.backend.send(error, params)
+                self.sent_count += 1
+            except Exception as e:
+                logger.exception(e)
+
+    def stop(self, timeout=5):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+
+NOTIFIER = None
+
+
+def get_notifier():
+    global NOTIFIER
+    if NOTIFIER is None:
+        backend = BACKENDS[os.environ.get('LEEK_ALERT_BACKEND', 'airbrake')]()
+        NOTIFIER = AlertNotifier(backend)
+    return NOTIFIER
+
+
+def set_backend(backend):
+    global NOTIFIER
+    NOTIFIER = AlertNotifier(backend)
+    return NOTIFIER
+
+
+@atexit.register
+def stop_notifier():
+    if NOTIFIER is not None:
+        NOTIFIER.stop()
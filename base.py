@@ -35,3 +35,57 @@ class ArbitrageConfig(object):
         self.quote_coin_alert_num = float(options['quote_coin_alert_num'])
         self.bisect_coin = options['bisect_coin']  # 计算利润时,是否按照平分币两到个市场计算,还是按一个.如果经常是单边市场,可以设置成 False
         self.enable_transfer = options['enable_transfer']  # 不开启转帐交易,则默认不计算提现费.适合两个市场互相有溢价,或手续费过高
+        self.order_book_depth = int(options.get('order_book_depth', 100))  # 每边深度最多保留档位数
+        self.event_driven = options.get('event_driven', False)  # 深度变化时立即计算套利机会,而不是每秒轮询一次
+        self.concurrent_legs = options.get('concurrent_legs', False)  # 买卖两单同时下,需要两个市场都有币 (bisect_coin)
+        self.order_timeout = float(options.get('order_timeout', 7))  # 下单后等待成交的最长秒数,超时撤单
+        self.record_path = options.get('record_path', None)  # 记录 ws 深度数据的文件, 用于 replay 回测
+        self.ready_timeout = float(options.get('ready_timeout', 60))  # 启动时等待两个市场收到第一份深度的最长秒数
+        self.optimize_size = options.get('optimize_size', False)  # 两边深度一起往深处走, 按利润最大的数量下单, 而不是只吃到最小交易金额
+        self.max_book_age = float(options.get('max_book_age', 0))  # 任一市场深度超过此秒数没有更新时不计算套利, 0 不检查
+
+
+class VenueConfig(object):
+    def __init__(self, options={}):
+        self.id = options['id']
+        self.api_key = options['api_key']
+        self.secret = options['secret']
+        self.password = options.get('password', None)
+        self.new_ws = options.get('new_ws', None)
+        self.taker_fee = float(options['taker_fee'])  # 吃单成交费用, 1% 之类的
+        self.withdraw_base_fee = float(options['withdraw_base_fee'])  # 提现统一预估一个固定值,而不是百分比
+        self.withdraw_quote_fee = float(options['withdraw_quote_fee'])
+
+
+# 一个交易对在多个市场之间套利, exchanges 为 VenueConfig 的参数列表
+class MultiArbitrageConfig(object):
+    def __init__(self, options={}):
+        self.name = options['name']
+        self.base_coin = options['base_coin']
+        self.quote_coin = options['quote_coin']
+        self.symbol = f"{self.base_coin}/{self.quote_coin}"
+        self.pure_profit_limit = float(options['pure_profit_limit'])  # 任意两个市场之间低买高卖的纯利润限制, 5%
+        self.min_buy_num_limit_by_quote = options['min_buy_num_limit_by_quote']
+        if self.min_buy_num_limit_by_quote is not None:
+            self.min_buy_num_limit_by_quote = float(self.min_buy_num_limit_by_quote)
+        self.max_buy_num_limit_by_quote = options['max_buy_num_limit_by_quote']
+        if self.max_buy_num_limit_by_quote is not None:
+            self.max_buy_num_limit_by_quote = float(self.max_buy_num_limit_by_quote)
+        self.max_open_order_limit = float(options['max_open_order_limit'])
+        self.base_coin_num = float(options['base_coin_num'])
+        self.quote_coin_num = float(options['quote_coin_num'])
+        self.base_coin_alert_num = float(options['base_coin_alert_num'])
+        self.quote_coin_alert_num = float(options['quote_coin_alert_num'])
+        self.bisect_coin = options['bisect_coin']
+        self.enable_transfer = options['enable_transfer']
+        self.order_book_depth = int(options.get('order_book_depth', 100))
+        self.event_driven = True  # 多市场只在深度变化时计算
+        self.concurrent_legs = options.get('concurrent_legs', False)
+        self.ready_timeout = float(options.get('ready_timeout', 60))
+        self.optimize_size = options.get('optimize_size', False)
+        self.max_book_age = float(options.get('max_book_age', 0))
+        self.order_timeout = float(options.get('order_timeout', 7))
+        self.exchanges = [VenueConfig(item) for item in options['exchanges']]
+        exchange_ids = [item.id for item in self.exchanges]
+        if len(exchange_ids) < 2 or len(set(exchange_ids)) != len(exchange_ids):
+            raise RuntimeError(f"{self.name} exchanges must be at least two different exchanges: {exchange_ids}")
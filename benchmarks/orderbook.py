@@ -0,0 +1,47 @@
+# OrderBookSide 和 SortedDict 对比
+# python -m leek.benchmarks.orderbook
+import random
+import time
+from sortedcontainers import SortedDict
+from ..orderbook import OrderBookSide, update_order_book
+
+
+def gen_messages(num, seed=1, mid=100.0, tick=0.01, levels=20):
+    # 模拟 ws 增量推送: 每条消息更新若干档, 越靠近盘口越频繁, 约三成是撤档
+    rnd = random.Random(seed)
+    messages = []
+    for _ in range(num):
+        mid += rnd.choice((-tick, 0.0, tick))
+        asks = []
+        bids = []
+        for _ in range(rnd.randint(1, levels)):
+            offset = int(rnd.expovariate(0.05)) + 1
+            volume = 0.0 if rnd.random() < 0.3 else round(rnd.uniform(0.01, 10.0), 4)
+            asks.append([round(mid + offset * tick, 2), volume])
+            offset = int(rnd.expovariate(0.05)) + 1
+            volume = 0.0 if rnd.random() < 0.3 else round(rnd.uniform(0.01, 10.0), 4)
+            bids.append([round(mid - offset * tick, 2), volume])
+        messages.append({'full': False, 'asks': asks, 'bids': bids})
+    return messages
+
+
+def run_one(name, asks, bids, messages):
+    start = time.perf_counter()
+    for data in messages:
+        update_order_book(asks, bids, data)
+        if asks and bids:
+            asks.peekitem(0)
+            bids.peekitem(-1)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<24} {len(messages) / elapsed:>12.0f} msg/s  levels asks {len(asks)} bids {len(bids)}")
+
+
+def main():
+    messages = gen_messages(200000)
+    run_one('SortedDict', SortedDict(), SortedDict(), messages)
+    for depth in (20, 100, 500):
+        run_one(f'OrderBookSide({depth})', OrderBookSide(max_depth=depth), OrderBookSide(is_bids=True, max_depth=depth), messages)
+
+
+if __name__ == '__main__':
+    main()
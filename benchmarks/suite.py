@@ -0,0 +1,263 @@
+# 深度更新和套利计算热路径的基准测试, 行情按随机种子生成, 结果输出为 json, 便于不同版本之间对比
+# python -m leek.benchmarks.suite --output new.json --compare old.json
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import subprocess
+import tracemalloc
+from .orderbook import gen_messages
+from .. import bookstore
+from .. import order_tracker
+from .. import scanner
+from .. import scheduler
+from .. import simexchange
+from ..base import ArbitrageConfig
+from ..bricklayer import Bricklayer
+from ..orderbook import OrderBookSide, update_order_book
+from ..simexchange import SimExchange, SimMarket
+
+
+def get_options(**kwargs):
+    options = {
+        'name': 'benchmark', 'base_coin': 'BTC', 'quote_coin': 'USDT',
+        'one_to_two_pure_profit_limit': 0.0005, 'two_to_one_pure_profit_limit': 0.0005,
+        'min_buy_num_limit_by_quote': 500, 'max_buy_num_limit_by_quote': 5000, 'max_open_order_limit': 5,
+        'base_coin_num': 100, 'quote_coin_num': 10000,
+        'exchange1_id': 'sim_bench1', 'exchange1_api_key': 'bench', 'exchange1_secret': 'bench',
+        'exchange2_id': 'sim_bench2', 'exchange2_api_key': 'bench', 'exchange2_secret': 'bench',
+        'exchange1_taker_fee': 0.001, 'exchange2_taker_fee': 0.001,
+        'exchange1_withdraw_base_fee': 0, 'exchange1_withdraw_quote_fee': 0,
+        'exchange2_withdraw_base_fee': 0, 'exchange2_withdraw_quote_fee': 0,
+        'base_coin_alert_num': 0, 'quote_coin_alert_num': 0, 'bisect_coin': True, 'enable_transfer': False,
+    }
+    options.update(kwargs)
+    return options
+
+
+def gen_snapshots(num, depth, seed=1, mid=100.0, tick=0.01):
+    rnd = random.Random(seed)
+    snapshots = []
+    for _ in range(num):
+        mid += rnd.choice((-tick, 0.0, tick))
+        asks = [[round(mid + i * tick, 2), round(rnd.uniform(0.01, 10.0), 4)] for i in range(1, depth + 1)]
+        bids = [[round(mid - i * tick, 2), round(rnd.uniform(0.01, 10.0), 4)] for i in range(1, depth + 1)]
+        snapshots.append({'full': True, 'asks': asks, 'bids': bids})
+    return snapshots
+
+
+def best_of(repeat, func):
+    # 多次运行取最快的一次, 减少机器抖动的影响
+    return min(func() for _ in range(repeat))
+
+
+def bench_update(messages, depth, repeat):
+    def run():
+        asks = OrderBookSide(max_depth=depth)
+        bids = OrderBookSide(is_bids=True, max_depth=depth)
+        start = time.perf_counter()
+        for data in messages:
+            update_order_book(asks, bids, data)
+        return time.perf_counter() - start
+    return len(messages) / best_of(repeat, run)
+
+
+def bench_best_price(bricklayer, depth, num, repeat, seed):
+    # 每次先改动盘口一档, 使累计量失效, 再取 vwap 价格
+    rnd = random.Random(seed)
+    asks = OrderBookSide(max_depth=depth)
+    bids = OrderBookSide(is_bids=True, max_depth=depth)
+    update_order_book(asks, bids, gen_snapshots(1, depth, seed)[0])
+    volumes = [round(rnd.uniform(0.01, 10.0), 4) for _ in range(num)]
+    ask_price = asks.best()[0]
+    bid_price = bids.best()[0]
+
+    def run():
+        start = time.perf_counter()
+        for volume in volumes:
+            asks[ask_price] = volume
+            bids[bid_price] = volume
+            bricklayer.get_best_ask(asks)
+            bricklayer.get_best_bid(bids)
+        return time.perf_counter() - start
+    return num * 2 / best_of(repeat, run)
+
+
+async def _bench_decisions(num, seed):
+    config = ArbitrageConfig(get_options())
+    b = Bricklayer(config)
+    config.order_timeout = 0
+    # 同一交易对的公共中间价是全局的, 每次重新开始保证结果可重复
+    simexchange.SIM_MID_PRICES.pop(config.symbol, None)
+    market_options = {'seed': seed, 'levels': 50, 'divergence': 0.002}
+    balances = {config.base_coin: 1e9, config.quote_coin: 1e11}
+    market1 = SimMarket(config.exchange1_id, config.symbol, b.exchange1_asks, b.exchange1_bids, dict(market_options, seed=seed))
+    market2 = SimMarket(config.exchange2_id, config.symbol, b.exchange2_asks, b.exchange2_bids, dict(market_options, seed=seed + 1))
+    b.exchange1 = SimExchange(config.exchange1_id, {'apiKey': 'bench', 'balances': balances}, market1)
+    b.exchange2 = SimExchange(config.exchange2_id, {'apiKey': 'bench', 'balances': balances}, market2)
+    # 先生成行情, 只计算 _buy_low_and_sell_high 的耗时
+    try:
+        await b.update_balance()
+        elapsed = 0.0
+        for _ in range(num):
+            market1.step()
+            market2.step()
+            start = time.perf_counter()
+            await b._buy_low_and_sell_high(b.exchange1, b.exchange1_asks, b.exchange1_bids, b.exchange2, b.exchange2_asks,
+                                           b.exchange2_bids, b.exchange1_quote_coin_balance, b.exchange2_base_coin_balance,
+                                           config.one_to_two_pure_profit_limit)
+            await b._buy_low_and_sell_high(b.exchange2, b.exchange2_asks, b.exchange2_bids, b.exchange1, b.exchange1_asks,
+                                           b.exchange1_bids, b.exchange2_quote_coin_balance, b.exchange1_base_coin_balance,
+                                           config.two_to_one_pure_profit_limit)
+            elapsed += time.perf_counter() - start
+        return num * 2 / elapsed, len(b.exchange1.orders) + len(b.exchange2.orders)
+    finally:
+        for exchange in (b.exchange1, b.exchange2):
+            scheduler.SCHEDULERS.pop((exchange.id, exchange.apiKey), None)
+            order_tracker.ORDER_TRACKERS.pop((exchange.id, exchange.apiKey), None)
+
+
+def bench_decisions(num, repeat, seed):
+    results = [asyncio.run(_bench_decisions(num, seed)) for _ in range(repeat)]
+    return max(results)
+
+
+def bench_memory(pair_num, depth):
+    # 每个 Bricklayer 一个独立交易对, 深度放在 bookstore 中, 填满 depth 档
+    snapshot = gen_snapshots(1, depth)[0]
+    bricklayers = []
+    keys = []
+    tracemalloc.start()
+    start = tracemalloc.take_snapshot()
+    for i in range(pair_num):
+        b = Bricklayer(ArbitrageConfig(get_options(base_coin=f'B{i}', order_book_depth=depth)))
+        asyncio.run(b.update_order_book())
+        b.exchange1_book.ws_callback(snapshot)
+        b.exchange2_book.ws_callback(snapshot)
+        keys.append((b.exchange1.id, b.config.symbol))
+        keys.append((b.exchange2.id, b.config.symbol))
+        bricklayers.append(b)
+    end = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in end.compare_to(start, 'filename'))
+    for key in keys:
+        bookstore.ORDER_BOOKS.pop(key, None)
+    return size / pair_num
+
+
+def bench_scan(pair_num, num, repeat, seed):
+    # 每次一个套利对的深度变化, scanner 刷新一行后计算全部套利对
+    rnd = random.Random(seed)
+    bricklayers = []
+    for i in range(pair_num):
+        b = Bricklayer(ArbitrageConfig(get_options()))
+        update_order_book(b.exchange1_asks, b.exchange1_bids, gen_snapshots(1, 100, seed + i)[0])
+        update_order_book(b.exchange2_asks, b.exchange2_bids, gen_snapshots(1, 100, seed + i + pair_num)[0])
+        bricklayers.append(b)
+    opportunity_scanner = scanner.OpportunityScanner(bricklayers)
+    rows = [rnd.randrange(pair_num) for _ in range(num)]
+
+    def run():
+        start = time.perf_counter()
+        for row in rows:
+            opportunity_scanner.dirty.add(row)
+            opportunity_scanner.scan()
+        return time.perf_counter() - start
+    return num / best_of(repeat, run)
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def run_suite(quick=False, seed=1):
+    scale = 10 if quick else 1
+    repeat = 1 if quick else 3
+    results = []
+
+    def add(name, params, value, unit, better='higher'):
+        results.append({'name': name, 'params': params, 'value': value, 'unit': unit, 'better': better})
+        print(f"{name:<24} {json.dumps(params):<28} {value:>14.1f} {unit}", file=sys.stderr)
+
+    for depth in (20, 100, 500):
+        snapshots = gen_snapshots(20000 // scale, depth, seed)
+        add('update_snapshot', {'depth': depth}, bench_update(snapshots, depth, repeat), 'msg/s')
+    messages = gen_messages(200000 // scale, seed)
+    for depth in (20, 100, 500):
+        add('update_delta', {'depth': depth}, bench_update(messages, depth, repeat), 'msg/s')
+
+    bricklayer = Bricklayer(ArbitrageConfig(get_options()))
+    for depth in (5, 20, 100, 500):
+        for quote in (100, 5000):
+            bricklayer.config.min_buy_num_limit_by_quote = quote
+            add('best_price', {'depth': depth, 'quote': quote}, bench_best_price(bricklayer, depth, 100000 // scale, repeat, seed), 'call/s')
+
+    value, order_count = bench_decisions(5000 // scale, repeat, seed)
+    add('decisions', {'orders': order_count}, value, 'decision/s')
+
+    for pair_num in (10, 100, 1000):
+        add('scan', {'pairs': pair_num}, bench_scan(pair_num, 10000 // scale, repeat, seed), 'scan/s')
+
+    for pair_num in (1, 10, 50):
+        add('memory_per_bricklayer', {'pairs': pair_num, 'depth': 100}, bench_memory(pair_num, 100), 'bytes', 'lower')
+    return results
+
+
+def compare(old_results, new_results, threshold):
+    # 返回变差超过 threshold 比例的项
+    old_values = {(item['name'], json.dumps(item['params'], sort_keys=True)): item for item in old_results}
+    regressions = []
+    for item in new_results:
+        old_item = old_values.get((item['name'], json.dumps(item['params'], sort_keys=True)))
+        if old_item is None or not old_item['value']:
+            continue
+        ratio = item['value'] / old_item['value']
+        worse = ratio < 1 - threshold if item['better'] == 'higher' else ratio > 1 + threshold
+        print(f"{item['name']:<24} {json.dumps(item['params']):<28} {old_item['value']:>14.1f} -> {item['value']:>14.1f} "
+              f"x{ratio:.3f}{' REGRESSION' if worse else ''}", file=sys.stderr)
+        if worse:
+            regressions.append(item)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', help='结果 json 文件, 默认输出到 stdout')
+    parser.add_argument('--compare', help='对比的旧结果 json 文件')
+    parser.add_argument('--threshold', type=float, default=0.1, help='变差超过此比例视为退化')
+    parser.add_argument('--quick', action='store_true', help='数据量减为 1/10, 只跑一次')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    data = {
+        'meta': {
+            'time': time.time(),
+            'commit': get_git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'quick': args.quick,
+            'seed': args.seed,
+        },
+        'results': run_suite(args.quick, args.seed),
+    }
+    text = json.dumps(data, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            old_data = json.load(f)
+        if compare(old_data['results'], data['results'], args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+import os
+import time
+import asyncio
+from . import logutils
+from . import metrics
+from . import orderbook
+from . import scheduler
+from . import utils
+
+logger = logutils.get_logger('leek-bookstore')
+
+# 同一交易所同一交易对只订阅一次 ws, 深度只更新一次, 再通知所有 Bricklayer
+ORDER_BOOKS = {}
+
+
+# ws 消息带 seq (本条序号) 时检查是否断档: 有 prev_seq (上一条序号) 时要求等于上一条的 seq, 否则要求 seq 连续
+# 断档时用 REST fetch_order_book 重新同步这一份深度, 同步期间不通知 Bricklayer
+# 增量更新后买一高于卖一时照常通知 (录制需要每一条增量), 但 is_crossed() 为 True, Bricklayer 不计算;
+# 有的交易所增量本来就会短暂交叉, 连续 LEEK_BOOK_CROSSED_LIMIT 条或持续 LEEK_BOOK_CROSSED_SECONDS 秒仍交叉才重新同步
+class SharedOrderBook(object):
+    def __init__(self, exchange_id, symbol, max_depth=100, exchange=None):
+        self.exchange_id = exchange_id
+        self.symbol = symbol
+        self.exchange = exchange
+        self.asks = orderbook.OrderBookSide(max_depth=max_depth)
+        self.bids = orderbook.OrderBookSide(is_bids=True, max_depth=max_depth)
+        self.listeners = []
+        self.update_count = 0
+        self.full_update_count = 0
+        self.observer = None
+        # 最近一次收到 ws 消息和深度更新完成的时间
+        self.received_at = None
+        self.updated_at = None
+        # 收到第一份完整深度后设置
+        self.ready = asyncio.Event()
+        self.update_seconds = metrics.histogram('leek_book_update_seconds', exchange=exchange_id, symbol=symbol)
+        self.last_seq = None
+        self.gap_count = 0
+        self.resync_count = 0
+        # 重新同步期间收到的增量, 同步完成后按 seq 补上
+        self.resync_task = None
+        self.resync_buffer = []
+        # 连续交叉的增量条数和开始交叉的时间
+        self.crossed_count = 0
+        self.crossed_at = None
+        self.crossed_limit = int(os.environ.get('LEEK_BOOK_CROSSED_LIMIT', 5))
+        self.crossed_seconds = float(os.environ.get('LEEK_BOOK_CROSSED_SECONDS', 1))
+
+    def add_listener(self, callback, max_depth=None):
+        if max_depth is not None and max_depth > self.asks.max_depth:
+            self.asks.max_depth = max_depth
+            self.bids.max_depth = max_depth
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        try:
+            self.listeners.remove(callback)
+        except ValueError:
+            pass
+
+    def is_resyncing(self):
+        return self.resync_task is not None
+
+    # 增量更新后交叉, 还在等后续增量恢复
+    def is_crossed(self):
+        return self.crossed_count > 0
+
+    # 距离最近一次深度更新的秒数, 还没有数据时为 None
+    def get_age(self, now=None):
+        if self.updated_at is None:
+            return None
+        return (time.time() if now is None else now) - self.updated_at
+
+    def ws_callback(self, data):
+        self.received_at = time.time()
+        if self.resync_task is not None:
+            if data['full']:
+                # ws 重新推送了完整深度, 不再需要 REST 快照
+                self.resync_task.cancel()
+                self.resync_task = None
+                self.resync_buffer = []
+            else:
+                self.resync_buffer.append(data)
+                return
+        seq = data.get('seq')
+        if seq is not None and self.last_seq is not None and not data['full']:
+            if seq <= self.last_seq:
+                return  # 重复或过期的消息
+            prev_seq = data.get('prev_seq')
+            if (prev_seq if prev_seq is not None else seq - 1) != self.last_seq and self._gap('seq', data):
+                return
+        self._apply(data)
+        resync = False
+        if not data['full'] and self.asks and self.bids and self.asks.best()[0] <= self.bids.best()[0]:
+            resync = self._is_crossed_too_long()
+        else:
+            self.crossed_count = 0
+            self.crossed_at = None
+        self._notify(data)
+        if resync:
+            self._gap('crossed', None)
+
+    def _is_crossed_too_long(self):
+        self.crossed_count += 1
+        if self.crossed_at is None:
+            self.crossed_at = self.received_at
+        return self.crossed_count >= self.crossed_limit or self.received_at - self.crossed_at >= self.crossed_seconds
+
+    def _apply(self, data):
+        orderbook.update_order_book(self.asks, self.bids, data)
+        if data.get('seq') is not None:
+            self.last_seq = data['seq']
+        self.updated_at = time.time()
+        self.update_seconds.observe(self.updated_at - self.received_at)
+        self.update_count += 1
+        if data['full']:
+            self.full_update_count += 1
+
+    def _notify(self, data):
+        if not self.ready.is_set() and (data['full'] or (self.asks and self.bids)):
+            self.ready.set()
+        for callback in self.listeners:
+            try:
+                callback(data)
+            except Exception as e:
+                logger.exception(e)
+
+    # 返回是否开始重新同步
+    def _gap(self, reason, data):
+        self.gap_count += 1
+        metrics.counter('leek_book_gaps_total', exchange=self.exchange_id, symbol=self.symbol, reason=reason).inc()
+        logger.warning("%s %s order book gap %s, last seq %s", self.exchange_id, self.symbol, reason, self.last_seq)
+        if self.exchange is None:
+            # 没有交易所实例时无法用 REST 同步, 照常更新, 等 ws 推送完整深度
+            return False
+        self.resync_buffer = [data] if data is not None else []
+        self.crossed_count = 0
+        self.crossed_at = None
+        self.resync_task = asyncio.ensure_future(self._resync())
+        return True
+
+    async def _resync(self):
+        try:
+            while True:
+                try:
+                    snapshot = await scheduler.call(self.exchange, scheduler.PRIORITY_REFRESH, 'fetch_order_book', self.symbol)
+                    break
+                except Exception as e:
+                    metrics.counter('leek_book_resyncs_total', exchange=self.exchange_id, symbol=self.symbol, status='error').inc()
+                    logger.warning("%s %s order book resync failed %r", self.exchange_id, self.symbol, e)
+                    if utils.exit_signal:
+                        return
+                    await asyncio.sleep(1)
+        finally:
+            if self.resync_task is asyncio.current_task():
+                self.resync_task = None
+        self.resync_count += 1
+        metrics.counter('leek_book_resyncs_total', exchange=self.exchange_id, symbol=self.symbol, status='ok').inc()
+        buffer = self.resync_buffer
+        self.resync_buffer = []
+        nonce = snapshot.get('nonce')
+        if not is_comparable_nonce(nonce, buffer):
+            nonce = None
+        data = {'full': True, 'asks': snapshot['asks'], 'bids': snapshot['bids'], 'seq': nonce}
+        self.received_at = time.time()
+        self._apply(data)
+        if nonce is None:
+            # 无法判断期间的增量是否已包含在快照中, 丢弃, 从最后一条的序号继续检查
+            self.last_seq = buffer[-1].get('seq') if buffer else None
+        logger.info("%s %s order book resynced, seq %s, buffered %s", self.exchange_id, self.symbol, nonce, len(buffer))
+        self._notify(data)
+        if nonce is not None:
+            for item in buffer:
+                self.ws_callback(item)
+
+    def stats(self):
+        return {
+            'exchange_id': self.exchange_id,
+            'symbol': self.symbol,
+            'ask_levels': len(self.asks),
+            'bid_levels': len(self.bids),
+            'nbytes': self.asks.nbytes() + self.bids.nbytes(),
+            'update_count': self.update_count,
+            'full_update_count': self.full_update_count,
+            'gap_count': self.gap_count,
+            'resync_count': self.resync_count,
+            'listener_count': len(self.listeners),
+        }
+
+
+# 很多交易所 REST 深度的 nonce 和 ws 增量的 seq 不是同一个序号, 只有 nonce 落在同步期间收到的增量序号范围内才认为可比较:
+# 不小于第一条增量的上一条序号, 不大于最后一条的序号
+def is_comparable_nonce(nonce, buffer):
+    items = [item for item in buffer if item.get('seq') is not None]
+    if nonce is None or not items:
+        return False
+    prev_seq = items[0].get('prev_seq')
+    if prev_seq is None:
+        prev_seq = items[0]['seq'] - 1
+    return prev_seq <= nonce <= items[-1]['seq']
+
+
+def get_order_book(exchange, symbol, callback, new_ws=None, max_depth=100):
+    key = (exchange.id, symbol)
+    book = ORDER_BOOKS.get(key)
+    if book is None:
+        book = SharedOrderBook(exchange.id, symbol, max_depth, exchange)
+        exchange_ws = utils.get_exchange_ws(exchange.id, new_ws)
+        book.observer = utils.get_exchange_observer(exchange, symbol, book.ws_callback)
+        exchange_ws.subscribe(book.observer)
+        ORDER_BOOKS[key] = book
+    book.add_listener(callback, max_depth)
+    return book
+
+
+# 等待深度都收到第一份数据, 超时返回 False
+async def wait_order_books_ready(books, timeout):
+    try:
+        await asyncio.wait_for(asyncio.gather(*[book.ready.wait() for book in books]), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+
+def get_order_book_stats():
+    return [book.stats() for book in ORDER_BOOKS.values()]
+
+
+def collect_metrics():
+    now = time.time()
+    for book in ORDER_BOOKS.values():
+        labels = {'exchange': book.exchange_id, 'symbol': book.symbol}
+        metrics.gauge('leek_book_ask_levels', **labels).set(len(book.asks))
+        metrics.gauge('leek_book_bid_levels', **labels).set(len(book.bids))
+        metrics.gauge('leek_book_updates', **labels).set(book.update_count)
+        metrics.gauge('leek_book_resyncing', **labels).set(1 if book.is_resyncing() else 0)
+        if book.updated_at is not None:
+            # 距离最近一次深度更新的秒数
+            metrics.gauge('leek_book_staleness_seconds', **labels).set(now - book.updated_at)
+
+
+metrics.add_collector(collect_metrics)
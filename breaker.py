@@ -0,0 +1,110 @@
+import os
+import time
+import ccxt
+from . import logutils
+from . import metrics
+
+logger = logutils.get_logger('leek-breaker')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+# metrics 中的数值
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# 和 scheduler 一样, 同一个 (exchange_id, api_key) 一个熔断器
+BREAKERS = {}
+
+
+class BreakerOpenError(RuntimeError):
+    pass
+
+
+def is_venue_failure(e):
+    # 超时, 网络错误, 限流, 交易所维护才算市场故障; 余额不足, 下单参数错误之类说明交易所是正常的
+    return isinstance(e, (ccxt.NetworkError, BreakerOpenError))
+
+
+# 连续失败 threshold 次后打开, 打开期间直接拒绝请求; 到期后半开, 只放行一个试探请求,
+# 成功则关闭, 失败则再次打开, 打开时间从 base_delay 开始每次翻倍, 最长 max_delay
+class CircuitBreaker(object):
+    def __init__(self, key, threshold=3, base_delay=1.0, max_delay=300.0, clock=time.monotonic):
+        self.key = key
+        self.threshold = threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self.state = CLOSED
+        self.failure_count = 0
+        # 连续打开次数, 决定下次打开多久
+        self.open_count = 0
+        self.retry_at = 0.0
+        self.probing = False
+
+    def allow(self):
+        if self.state == OPEN:
+            if self.clock() < self.retry_at:
+                return False
+            self.state = HALF_OPEN
+            self.probing = False
+        if self.state == HALF_OPEN:
+            if self.probing:
+                return False
+            self.probing = True
+        return True
+
+    # 试探请求还没执行就被取消了, 让下一个请求试探
+    def cancel_probe(self):
+        self.probing = False
+
+    def is_suspended(self):
+        return self.state != CLOSED
+
+    def get_delay(self):
+        return min(self.base_delay * 2 ** max(self.open_count - 1, 0), self.max_delay)
+
+    def record_success(self):
+        if self.state != CLOSED:
+            logger.info("%s breaker closed", self.key[0])
+        self.state = CLOSED
+        self.failure_count = 0
+        self.open_count = 0
+        self.probing = False
+
+    # 返回本次是否打开了熔断器
+    def record_failure(self):
+        self.failure_count += 1
+        if self.state == OPEN:
+            return False
+        if self.state == CLOSED and self.failure_count < self.threshold:
+            return False
+        self.state = OPEN
+        self.probing = False
+        self.open_count += 1
+        delay = self.get_delay()
+        self.retry_at = self.clock() + delay
+        metrics.counter('leek_breaker_opens_total', exchange=self.key[0]).inc()
+        logger.warning("%s breaker open for %s seconds, failure count %s", self.key[0], delay, self.failure_count)
+        return True
+
+
+def get_breaker(exchange):
+    key = (exchange.id, exchange.apiKey)
+    if key not in BREAKERS:
+        BREAKERS[key] = CircuitBreaker(key, int(os.environ.get('LEEK_BREAKER_THRESHOLD', 3)),
+                                       float(os.environ.get('LEEK_BREAKER_BASE_DELAY', 1)),
+                                       float(os.environ.get('LEEK_BREAKER_MAX_DELAY', 300)))
+    return BREAKERS[key]
+
+
+def is_suspended(exchange):
+    breaker = BREAKERS.get((exchange.id, exchange.apiKey))
+    return breaker is not None and breaker.is_suspended()
+
+
+def collect_metrics():
+    for breaker in list(BREAKERS.values()):
+        metrics.gauge('leek_breaker_state', exchange=breaker.key[0]).set(STATE_VALUES[breaker.state])
+
+
+metrics.add_collector(collect_metrics)
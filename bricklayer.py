@@ -1,12 +1,27 @@
+import os
 import asyncio
-import ccxtws
 import random
-from sortedcontainers import SortedDict
+import time
+from collections import deque
+import ccxt
+from . import alerts
+from . import bookstore
+from . import breaker
+from . import journal
+from . import ledger
 from . import logutils
+from . import markets
+from . import metrics
+from . import order_tracker
+from . import orderbook
+from . import recorder
+from . import scheduler
+from . import sizing
 from . import utils
 
 logger = logutils.get_logger('leek-bricklayer')
-notifier = utils.get_airbrake_notifier()
+# 每次计算都可能输出的日志, 按时间采样
+sampled_logger = logutils.SampledLogger(logger)
 
 
 class Bricklayer(object):
@@ -21,21 +36,19 @@ class Bricklayer(object):
             exchange2_options['password'] = config.exchange2_password
         self.exchange2 = utils.get_exchange(config.exchange2_id, exchange2_options)
 
-        self.exchange1_base_coin_balance = 0.0
-        self.exchange1_quote_coin_balance = 0.0
-        self.exchange2_base_coin_balance = 0.0
-        self.exchange2_quote_coin_balance = 0.0
+        # 余额, 成交后本地更新, 定时全量获取校对
+        self.ledger = ledger.get_ledger()
 
         # 挂单数
         self.exchange1_open_order_num = 0
         self.exchange2_open_order_num = 0
 
         # Order book
-        # asks 委卖单, bids 委买单
-        self.exchange1_asks = SortedDict()
-        self.exchange1_bids = SortedDict()
-        self.exchange2_asks = SortedDict()
-        self.exchange2_bids = SortedDict()
+        # asks 委卖单, bids 委买单, update_order_book 后换成 bookstore 中共享的深度
+        self.exchange1_asks = orderbook.OrderBookSide(max_depth=config.order_book_depth)
+        self.exchange1_bids = orderbook.OrderBookSide(is_bids=True, max_depth=config.order_book_depth)
+        self.exchange2_asks = orderbook.OrderBookSide(max_depth=config.order_book_depth)
+        self.exchange2_bids = orderbook.OrderBookSide(is_bids=True, max_depth=config.order_book_depth)
 
         # balance_alert
         self.exchange1_base_coin_alerted = False
@@ -43,9 +56,45 @@ class Bricklayer(object):
         self.exchange2_base_coin_alerted = False
         self.exchange2_quote_coin_alerted = False
 
-        self.api_call_lock = asyncio.Lock()
         self.is_ready = False
 
+        # event_driven 模式, ws 回调只标记深度已变化,由 move_brick 合并多次更新后计算一次
+        self.order_book_event = asyncio.Event()
+        self.evaluated_tops = {}
+        # 每个市场最近一次收到 ws 深度消息的时间, 用于统计从行情到下单的延迟
+        self.tick_at = {}
+
+        # 每次套利两单确认时间差, 秒
+        self.leg_skews = deque(maxlen=1000)
+        # 交易所接口抛出非网络异常 (余额不足, 下单参数错误之类) 后暂停该市场到此时间, exchange_id -> 时间戳
+        self.venue_retry_at = {}
+
+        # 套利决策和订单结果, 设置 LEEK_JOURNAL_PATH 时记录
+        self.journal = journal.get_journal()
+        self.trade_id = 0
+
+        # 记录 ws 深度数据, 用于回放
+        self.recorder = None
+        if config.record_path is not None:
+            self.recorder = recorder.OrderBookRecorder(config.record_path, {
+                'name': config.name, 'symbol': config.symbol, 'exchange1_id': config.exchange1_id, 'exchange2_id': config.exchange2_id})
+
+    @property
+    def exchange1_base_coin_balance(self):
+        return self.ledger.get(self.exchange1, self.config.base_coin)
+
+    @property
+    def exchange1_quote_coin_balance(self):
+        return self.ledger.get(self.exchange1, self.config.quote_coin)
+
+    @property
+    def exchange2_base_coin_balance(self):
+        return self.ledger.get(self.exchange2, self.config.base_coin)
+
+    @property
+    def exchange2_quote_coin_balance(self):
+        return self.ledger.get(self.exchange2, self.config.quote_coin)
+
     async def balance_alert(self):
         if self.exchange1_base_coin_alerted:
             if self.exchange1_base_coin_balance >= self.config.base_coin_alert_num:
@@ -78,79 +127,137 @@ class Bricklayer(object):
 
     def balance_alert_notice(self, exchange_id, coin_name, num):
         msg = f"{exchange_id} {coin_name} {num} alert, {self.config.name}"
-        notice = notifier.build_notice(msg)
-        notice['params']['name'] = self.config.name
-        notifier.send_notice(notice)
+        alerts.get_notifier().notify(msg, {'name': self.config.name}, key=(self.config.name, exchange_id, coin_name))
 
     async def update_balance(self):
         try:
-            datas = await asyncio.gather(self.exchange1.fetch_balance(), self.exchange2.fetch_balance())
-            data = datas[0]
-            if self.config.base_coin in data:
-                self.exchange1_base_coin_balance = data[self.config.base_coin]['free']
-            else:
-                self.exchange1_base_coin_balance = 0.0
-            if self.config.quote_coin in data:
-                self.exchange1_quote_coin_balance = data[self.config.quote_coin]['free']
-            else:
-                self.exchange1_quote_coin_balance = 0.0
-            data = datas[1]
-            if self.config.base_coin in data:
-                self.exchange2_base_coin_balance = data[self.config.base_coin]['free']
-            else:
-                self.exchange2_base_coin_balance = 0.0
-            if self.config.quote_coin in data:
-                self.exchange2_quote_coin_balance = data[self.config.quote_coin]['free']
-            else:
-                self.exchange2_quote_coin_balance = 0.0
+            # 一个市场失败不影响另一个市场校对
+            datas = await asyncio.gather(scheduler.call(self.exchange1, scheduler.PRIORITY_REFRESH, 'fetch_balance'),
+                                         scheduler.call(self.exchange2, scheduler.PRIORITY_REFRESH, 'fetch_balance'),
+                                         return_exceptions=True)
             kind = f'{self.config.symbol} exchange1 {self.exchange1.id}, exchange2 {self.exchange2.id},'
+            for exchange, data in zip((self.exchange1, self.exchange2), datas):
+                if isinstance(data, Exception):
+                    logger.warning("%s %s fetch_balance failed %r", kind, exchange.id, data)
+                else:
+                    self._reconcile_balance(kind, exchange, data)
             logger.debug("%s balance | exchange1_base_coin_balance %s | exchange1_quote_coin_balance %s " +
                          "| exchange2_base_coin_balance %s exchange2_quote_coin_balance %s",
                          kind, self.exchange1_base_coin_balance, self.exchange1_quote_coin_balance,
                          self.exchange2_base_coin_balance, self.exchange2_quote_coin_balance)
+            # 余额已变化,深度不变也需要重新计算
+            self.evaluated_tops.clear()
         except Exception as e:
             logger.exception(e)
 
+    def _reconcile_balance(self, kind, exchange, data):
+        for coin in (self.config.base_coin, self.config.quote_coin):
+            num = data[coin]['free'] if coin in data else 0.0
+            drift = self.ledger.reconcile(exchange, coin, num)
+            if drift != 0.0:
+                logger.debug("%s %s %s balance drift %s", kind, exchange.id, coin, drift)
+
     async def update_open_orders(self):
         try:
             datas = await asyncio.gather(
-                self.exchange1.fetch_open_orders(symbol=self.config.symbol), self.exchange2.fetch_open_orders(symbol=self.config.symbol))
-            self.exchange1_open_order_num = len(datas[0])
-            self.exchange2_open_order_num = len(datas[1])
+                scheduler.call(self.exchange1, scheduler.PRIORITY_REFRESH, 'fetch_open_orders', symbol=self.config.symbol),
+                scheduler.call(self.exchange2, scheduler.PRIORITY_REFRESH, 'fetch_open_orders', symbol=self.config.symbol),
+                return_exceptions=True)
+            if isinstance(datas[0], Exception):
+                logger.warning("%s %s fetch_open_orders failed %r", self.config.symbol, self.exchange1.id, datas[0])
+            else:
+                self.exchange1_open_order_num = len(datas[0])
+            if isinstance(datas[1], Exception):
+                logger.warning("%s %s fetch_open_orders failed %r", self.config.symbol, self.exchange2.id, datas[1])
+            else:
+                self.exchange2_open_order_num = len(datas[1])
+            self.evaluated_tops.clear()
         except Exception as e:
             logger.exception(e)
 
     # run one
     async def update_order_book(self):
-        self.exchange1_ws = utils.get_exchange_ws(self.exchange1.id, self.config.exchange1_new_ws)
-        self.exchange2_ws = utils.get_exchange_ws(self.exchange2.id, self.config.exchange2_new_ws)
-        self.exchange1_observer = getattr(ccxtws, f'{self.exchange1.id}_observer')(self.exchange1, self.config.symbol, self.exchange1_ws_callback)
-        self.exchange2_observer = getattr(ccxtws, f'{self.exchange2.id}_observer')(self.exchange2, self.config.symbol, self.exchange2_ws_callback)
-        self.exchange1_ws.subscribe(self.exchange1_observer)
-        self.exchange2_ws.subscribe(self.exchange2_observer)
+        self.exchange1_book = bookstore.get_order_book(self.exchange1, self.config.symbol, self.exchange1_ws_callback,
+                                                       self.config.exchange1_new_ws, self.config.order_book_depth)
+        self.exchange2_book = bookstore.get_order_book(self.exchange2, self.config.symbol, self.exchange2_ws_callback,
+                                                       self.config.exchange2_new_ws, self.config.order_book_depth)
+        self.exchange1_asks = self.exchange1_book.asks
+        self.exchange1_bids = self.exchange1_book.bids
+        self.exchange2_asks = self.exchange2_book.asks
+        self.exchange2_bids = self.exchange2_book.bids
 
     async def move_brick(self):
         while True:
             if utils.exit_signal:
                 print("catch exit_signal")
                 break
-            await asyncio.sleep(1)
+            if self.config.event_driven:
+                await self._wait_order_book_changed()
+            else:
+                await asyncio.sleep(1)
             try:
-                await self._buy_low_and_sell_high(self.exchange1, self.exchange1_asks, self.exchange1_bids, self.exchange2, self.exchange2_asks,
-                                                  self.exchange2_bids, self.exchange1_quote_coin_balance, self.exchange2_base_coin_balance,
-                                                  self.config.one_to_two_pure_profit_limit)
-                await self._buy_low_and_sell_high(self.exchange2, self.exchange2_asks, self.exchange2_bids, self.exchange1, self.exchange1_asks,
-                                                  self.exchange1_bids, self.exchange2_quote_coin_balance, self.exchange1_base_coin_balance,
-                                                  self.config.two_to_one_pure_profit_limit)
+                await self.evaluate()
             except Exception as e:
-                logger.exception(e)
-                notice = notifier.build_notice(e)
-                notice['params']['name'] = self.config.name
-                notifier.send_notice(notice)
-                # 接口异常时暂停一小时再试
-                await asyncio.sleep(60 * 60)
+                await self._move_brick_exception(e)
+
+    async def evaluate(self):
+        if self._is_tops_changed('one_to_two', self.exchange1_asks, self.exchange2_bids):
+            await self.evaluate_one_to_two()
+        if self._is_tops_changed('two_to_one', self.exchange2_asks, self.exchange1_bids):
+            await self.evaluate_two_to_one()
+
+    # exchange1 低买 exchange2 高卖
+    async def evaluate_one_to_two(self):
+        await self._buy_low_and_sell_high(self.exchange1, self.exchange1_asks, self.exchange1_bids, self.exchange2, self.exchange2_asks,
+                                          self.exchange2_bids, self.exchange1_quote_coin_balance, self.exchange2_base_coin_balance,
+                                          self.config.one_to_two_pure_profit_limit)
+
+    # exchange2 低买 exchange1 高卖
+    async def evaluate_two_to_one(self):
+        await self._buy_low_and_sell_high(self.exchange2, self.exchange2_asks, self.exchange2_bids, self.exchange1, self.exchange1_asks,
+                                          self.exchange1_bids, self.exchange2_quote_coin_balance, self.exchange1_base_coin_balance,
+                                          self.config.two_to_one_pure_profit_limit)
+
+    async def _move_brick_exception(self, e):
+        logger.exception(e)
+        alerts.get_notifier().notify(e, {'name': self.config.name}, key=(self.config.name, type(e).__name__, str(e)))
+        if breaker.is_venue_failure(e):
+            # 交易所超时, 网络错误由该市场的熔断器暂停相关方向, 其他方向照常计算
+            await asyncio.sleep(1)
+        elif getattr(e, 'exchange_id', None) is not None:
+            # 交易所接口的其他异常只暂停涉及该市场的方向
+            delay = float(os.environ.get('LEEK_VENUE_ERROR_DELAY', 60 * 60))
+            self.venue_retry_at[e.exchange_id] = time.time() + delay
+            logger.warning("%s %s suspended for %s seconds", self.config.name, e.exchange_id, delay)
+            await asyncio.sleep(1)
+        else:
+            # 不是交易所接口的异常, 暂停一小时再试
+            await asyncio.sleep(60 * 60)
+
+    async def _wait_order_book_changed(self):
+        try:
+            # 超时是为了能及时检查 exit_signal
+            await asyncio.wait_for(self.order_book_event.wait(), timeout=1)
+        except asyncio.TimeoutError:
+            pass
+        self.order_book_event.clear()
+
+    def _is_tops_changed(self, direction, asks, bids):
+        if not self.config.event_driven:
+            return True
+        tops = (asks.peekitem(0) if asks else None, bids.peekitem(-1) if bids else None)
+        if self.evaluated_tops.get(direction) == tops:
+            return False
+        self.evaluated_tops[direction] = tops
+        return True
 
     async def run(self):
+        await self.start()
+        await self.move_brick()
+
+    # 初始化到两个市场都收到深度为止, 之后由 move_brick 或 scanner 计算套利
+    async def start(self):
+        await metrics.start_server()
         self.exchange1.checkRequiredCredentials()
         self.exchange2.checkRequiredCredentials()
         self._check_exchange_api_support(self.exchange1)
@@ -158,13 +265,9 @@ class Bricklayer(object):
 
         while True:
             try:
-                await self.exchange1.load_markets()
-                await self.exchange2.load_markets()
-                await asyncio.sleep(random.randint(1, 3))
-                await self.update_balance()
-                await asyncio.sleep(random.randint(1, 3))
-                await self.update_open_orders()
-                await asyncio.sleep(random.randint(1, 3))
+                # 市场信息同一交易所只下载一次; 请求都经过 scheduler 排队限速, 不需要再随机等待
+                await asyncio.gather(markets.load_markets(self.exchange1), markets.load_markets(self.exchange2))
+                await asyncio.gather(self.update_balance(), self.update_open_orders())
                 self.is_ready = True
                 break
             except Exception as e:
@@ -175,9 +278,11 @@ class Bricklayer(object):
 
         asyncio.create_task(self._timer_tasks())
 
-        # wait order book
-        await asyncio.sleep(10)
-        await self.move_brick()
+        await self._wait_order_book_ready([self.exchange1_book, self.exchange2_book])
+
+    async def _wait_order_book_ready(self, books):
+        if not await bookstore.wait_order_books_ready(books, self.config.ready_timeout):
+            logger.warning("%s order book not ready after %s seconds", self.config.name, self.config.ready_timeout)
 
     def _check_exchange_api_support(self, exchange):
         api_items = ['fetchBalance', 'fetchOpenOrders', 'createOrder', 'cancelOrder']
@@ -189,38 +294,26 @@ class Bricklayer(object):
         while True:
             await asyncio.sleep(random.randint(180, 300))
             try:
-                async with self.api_call_lock:
-                    await asyncio.sleep(random.randint(1, 3))
-                    await self.update_balance()
-                    await self.balance_alert()
-                    await asyncio.sleep(random.randint(1, 3))
-                    await self.update_open_orders()
+                await self.update_balance()
+                await self.balance_alert()
+                await self.update_open_orders()
             except Exception as e:
                 logger.exception(e)
 
-    def _update_order_book(self, asks, bids, data):
-        if data['full']:
-            asks.clear()
-            bids.clear()
-        for item in data['asks']:
-            self._update_order_book_dict(asks, item[0], item[1])
-        for item in data['bids']:
-            self._update_order_book_dict(bids, item[0], item[1])
-
-    def _update_order_book_dict(self, a_dict, price, volume):
-        if volume == 0.0:
-            try:
-                del a_dict[price]
-            except KeyError:
-                pass
-        else:
-            a_dict[price] = volume
-
+    # 深度已由 bookstore 更新, 这里只通知 move_brick; 深度交叉时只录制, 不触发计算
     def exchange1_ws_callback(self, data):
-        self._update_order_book(self.exchange1_asks, self.exchange1_bids, data)
+        self.tick_at[self.exchange1.id] = self.exchange1_book.received_at
+        if self.recorder is not None:
+            self.recorder.record(1, data)
+        if not self.exchange1_book.is_crossed():
+            self.order_book_event.set()
 
     def exchange2_ws_callback(self, data):
-        self._update_order_book(self.exchange2_asks, self.exchange2_bids, data)
+        self.tick_at[self.exchange2.id] = self.exchange2_book.received_at
+        if self.recorder is not None:
+            self.recorder.record(2, data)
+        if not self.exchange2_book.is_crossed():
+            self.order_book_event.set()
 
     def get_min_buy_num_limit(self, price):
         if price is None:
@@ -236,45 +329,69 @@ class Bricklayer(object):
     async def _buy_low_and_sell_high(self, ask_exchange, ask_asks, ask_bids, bid_exchange, bid_asks, bid_bids,
                                      ask_exchange_quote_coin_num, bid_exchange_base_coin_num, pure_profit_limit):
         kind = f'{self.config.symbol} low buy ask_exchange {ask_exchange.id}, sell high bid_exchange {bid_exchange.id},'
+        evaluated_at = time.time()
+        metrics.counter('leek_evaluations_total', name=self.config.name, ask_exchange=ask_exchange.id, bid_exchange=bid_exchange.id).inc()
+        self._observe_tick('leek_tick_to_evaluation_seconds', ask_exchange, bid_exchange, evaluated_at)
+        reason = self._get_unavailable_reason(ask_exchange, bid_exchange, evaluated_at)
+        if reason is not None:
+            self._skip(reason)
+            sampled_logger.debug('%s %s', kind, reason, key=kind)
+            # 恢复后深度不变也需要重新计算
+            self.evaluated_tops.clear()
+            return
         if not ask_asks or not bid_bids:
-            logger.debug('%s - ask_asks or bid_bids is null', kind)
+            self._skip('empty_book')
+            sampled_logger.debug('%s - ask_asks or bid_bids is null', kind, key=kind)
             return
 
         if ask_bids and self.get_last_ask(ask_asks)[0] <= self.get_last_bid(ask_bids)[0]:
-            logger.debug('%s - 低价单卖单被同市场已有单购买', kind)
+            self._skip('ask_book_crossed')
+            sampled_logger.debug('%s - 低价单卖单被同市场已有单购买', kind, key=kind)
             return
         if bid_asks and self.get_last_ask(bid_asks)[0] <= self.get_last_bid(bid_bids)[0]:
-            logger.debug('%s - 高价买单被同市场已有单卖出', kind)
+            self._skip('bid_book_crossed')
+            sampled_logger.debug('%s - 高价买单被同市场已有单卖出', kind, key=kind)
             return
 
         ask = self.get_best_ask(ask_asks)
         bid = self.get_best_bid(bid_bids)
         if ask[0] >= bid[0]:
-            logger.debug('%s - 卖价 %s - 买价 %s | 无溢价存在', kind, ask[0], bid[0])
+            self._skip('no_premium')
+            sampled_logger.debug('%s - 卖价 %s - 买价 %s | 无溢价存在', kind, ask[0], bid[0], key=kind)
             return
 
         premium_rate = (bid[0] - ask[0]) / ask[0]
-        logger.debug('%s - 卖价 %s 数量 %s - 买价 %s 数量 %s - 溢价 %s | 有溢价存在', kind, ask[0], ask[1], bid[0], bid[1], premium_rate)
+        sampled_logger.debug('%s - 卖价 %s 数量 %s - 买价 %s 数量 %s - 溢价 %s | 有溢价存在', kind, ask[0], ask[1], bid[0], bid[1], premium_rate,
+                             key=kind)
 
         # 先记录溢价,再检查是否符合交易条件
-        if self.exchange1_open_order_num >= self.config.max_open_order_limit:
-            logger.debug(f'{self.config.name} {self.exchange1.id} open_order_num {self.exchange1_open_order_num} > {self.config.max_open_order_limit}')
-            return
-        if self.exchange2_open_order_num >= self.config.max_open_order_limit:
-            logger.debug(f'{self.config.name} {self.exchange2.id} open_order_num {self.exchange2_open_order_num} > {self.config.max_open_order_limit}')
-            return
-
-        fee_rate = (self.get_cross_exchange_fee_rate(bid[0]) if self.config.enable_transfer else self.get_exchange_fee_rate(bid[0]))
+        for exchange in (ask_exchange, bid_exchange):
+            open_order_num = self._get_open_order_num(exchange)
+            if open_order_num >= self.config.max_open_order_limit:
+                self._skip('open_order_limit')
+                self._journal_decision('open_order_limit', ask_exchange, bid_exchange, ask, bid, premium_rate)
+                sampled_logger.debug('%s %s open_order_num %s > %s', self.config.name, exchange.id, open_order_num,
+                                     self.config.max_open_order_limit, key=kind)
+                return
+
+        fee_rate = (self.get_cross_exchange_fee_rate(bid[0], ask_exchange, bid_exchange) if self.config.enable_transfer
+                    else self.get_exchange_fee_rate(bid[0], ask_exchange, bid_exchange))
         if premium_rate <= fee_rate:
-            logger.debug('%s - 溢价率小于手续费,无套利空间 %s %s', kind, premium_rate, fee_rate)
+            self._skip('fee')
+            self._journal_decision('fee', ask_exchange, bid_exchange, ask, bid, premium_rate, fee_rate)
+            sampled_logger.debug('%s - 溢价率小于手续费,无套利空间 %s %s', kind, premium_rate, fee_rate, key=kind)
             return
 
         pure_profit = premium_rate - fee_rate
         if pure_profit <= pure_profit_limit:
-            logger.debug('%s 纯利润小于期望利润限值 %s %s', kind, pure_profit, pure_profit_limit)
+            self._skip('profit_limit')
+            self._journal_decision('profit_limit', ask_exchange, bid_exchange, ask, bid, premium_rate, fee_rate, pure_profit)
+            sampled_logger.debug('%s 纯利润小于期望利润限值 %s %s', kind, pure_profit, pure_profit_limit, key=kind)
             return
 
         if ask[1] < self.get_min_buy_num_limit(ask[0]) or bid[1] < self.get_min_buy_num_limit(bid[0]):
+            self._skip('order_num')
+            self._journal_decision('order_num', ask_exchange, bid_exchange, ask, bid, premium_rate, fee_rate, pure_profit)
             logger.debug('%s 单的数量过小', kind)
             return
 
@@ -283,9 +400,13 @@ class Bricklayer(object):
         max_buy_num = (ask_exchange_quote_coin_num / ask[0]) * 0.97
         max_sell_num = bid_exchange_base_coin_num
         if max_buy_num < min_buy_num_limit:
+            self._skip('quote_balance')
+            self._journal_decision('quote_balance', ask_exchange, bid_exchange, ask, bid, premium_rate, fee_rate, pure_profit, max_buy_num)
             logger.debug('%s quote coin %s 的数量过少 %s', kind, self.config.quote_coin, max_buy_num)
             return
         if max_sell_num < min_buy_num_limit:
+            self._skip('base_balance')
+            self._journal_decision('base_balance', ask_exchange, bid_exchange, ask, bid, premium_rate, fee_rate, pure_profit, max_sell_num)
             logger.debug('%s base coin %s 的数量过少 %s', kind, self.config.base_coin, max_sell_num)
             return
 
@@ -293,11 +414,29 @@ class Bricklayer(object):
         if buy_num > self.get_max_buy_num_limit(min_price):
             buy_num = self.get_max_buy_num_limit(min_price)
 
+        if self.config.optimize_size:
+            max_cost = min(ask_exchange_quote_coin_num * 0.97, self.config.max_buy_num_limit_by_quote)
+            sized = sizing.optimize_size(ask_asks, bid_bids, fee_rate, pure_profit_limit, max_sell_num, max_cost)
+            # 平均纯利润率满足限值, 比按最小交易金额算出的数量少时仍用原来的
+            if sized is not None and sized['num'] > buy_num:
+                logger.debug('%s optimize size %s -> %s buy levels %s sell levels %s profit %s', kind, buy_num, sized['num'],
+                             sized['buy_levels'], sized['sell_levels'], sized['profit'])
+                buy_num = sized['num']
+                ask = [sized['buy_price'], buy_num, sized['buy_vwap']]
+                bid = [sized['sell_price'], buy_num, sized['sell_vwap']]
+                pure_profit = sized['profit_rate']
+
+        decided_at = time.time()
+        metrics.counter('leek_decisions_total', name=self.config.name, ask_exchange=ask_exchange.id, bid_exchange=bid_exchange.id).inc()
+        metrics.histogram('leek_evaluation_seconds', name=self.config.name).observe(decided_at - evaluated_at)
+        self._observe_tick('leek_tick_to_decision_seconds', ask_exchange, bid_exchange, decided_at)
+        if self.journal is not None:
+            self.trade_id = self.journal.next_trade_id()
+            self._journal_decision('trade', ask_exchange, bid_exchange, ask, bid, premium_rate, fee_rate, pure_profit, buy_num)
         try:
-            async with self.api_call_lock:
-                await self._move_brick_trading(kind, ask_exchange, bid_exchange, ask, bid, buy_num, pure_profit)
-                await asyncio.sleep(1)
-                await self.update_balance()
+            await self._move_brick_trading(kind, ask_exchange, bid_exchange, ask, bid, buy_num, pure_profit)
+            # 余额已按成交在本地更新,深度不变也需要重新计算
+            self.evaluated_tops.clear()
         except Exception as e:
             logger.exception(e)
             await asyncio.sleep(1)
@@ -305,28 +444,63 @@ class Bricklayer(object):
             raise e
 
     async def _move_brick_trading(self, kind, ask_exchange, bid_exchange, ask, bid, num, pure_profit):
-        ret = await self.new_order(kind, 'buy', ask_exchange, ask[0], num)
-        num = ret['filled_num']
+        if self.config.concurrent_legs:
+            await self._move_brick_trading_concurrent(kind, ask_exchange, bid_exchange, ask, bid, num, pure_profit)
+            return
+        buy_ret = await self.new_order(kind, 'buy', ask_exchange, ask[0], num)
+        num = buy_ret['filled_num']
         if num <= 0:
             return  # 无成交
         min_price = min(ask[0], bid[0])
         # 66.6 个数量,下单后有可能交易所订单变成 66.0 个,导致后面不满足最低交易金额限制.所以增加 2% 的金额差异用来填平小数差
         if num < (self.get_min_buy_num_limit(min_price) * 0.80):
             # TODO 导致 base coin 一直增加,是否考虑直接市价卖了,但有些市场又不支持市价交易接口
-            logger.debug("%s buy_order order_id %s lt limit %s", kind, ret['order_id'], num)
+            logger.debug("%s buy_order order_id %s lt limit %s", kind, buy_ret['order_id'], num)
             return
 
         ret = await self.new_order(kind, 'sell', bid_exchange, bid[0], num)
+        self._record_leg_skew(kind, buy_ret, ret)
         num = ret['remaining_num']
         if ret['success']:
             filled_num = ret['filled_num']
             logger.debug('%s 交易成功,name %s buy_num %s 纯利润率 %s 大概利润 %s', kind, self.config.name, filled_num, pure_profit,
                          '{:.32f}'.format(filled_num * ask[0] * pure_profit))
             return
-        price = ask[0] + ask[0] * (self.get_exchange_fee_rate(bid[0]) + 0.002)  # 加 0.2%的滑点
+        await self._stop_loss_sell(kind, ask_exchange, bid_exchange, ask, bid, num, ret['order_id'])
+
+    # 库存已经平分在两个市场 (bisect_coin), 买卖两单同时下, 再按成交差额止损补单
+    async def _move_brick_trading_concurrent(self, kind, ask_exchange, bid_exchange, ask, bid, num, pure_profit):
+        buy_ret, sell_ret = await asyncio.gather(self.new_order(kind, 'buy', ask_exchange, ask[0], num),
+                                                 self.new_order(kind, 'sell', bid_exchange, bid[0], num), return_exceptions=True)
+        # 一单下单失败时另一单可能已经成交, 按未成交处理, 先止损补单再抛出异常
+        error = next((ret for ret in (buy_ret, sell_ret) if isinstance(ret, BaseException)), None)
+        if error is None:
+            self._record_leg_skew(kind, buy_ret, sell_ret)
+        else:
+            logger.warning("%s concurrent legs failed buy %r sell %r", kind, buy_ret, sell_ret)
+            if isinstance(buy_ret, BaseException):
+                buy_ret = self._failed_order_result(num)
+            if isinstance(sell_ret, BaseException):
+                sell_ret = self._failed_order_result(num)
+        filled_num = min(buy_ret['filled_num'], sell_ret['filled_num'])
+        if filled_num > 0:
+            logger.debug('%s 交易成功,name %s buy_num %s 纯利润率 %s 大概利润 %s', kind, self.config.name, filled_num, pure_profit,
+                         '{:.32f}'.format(filled_num * ask[0] * pure_profit))
+        diff_num = buy_ret['filled_num'] - sell_ret['filled_num']
+        if diff_num > 0:
+            # 买多了, 多出的币在高价市场止损卖出
+            await self._stop_loss_sell(kind, ask_exchange, bid_exchange, ask, bid, diff_num, sell_ret['order_id'])
+        elif diff_num < 0:
+            # 卖多了, 在低价市场止损买回
+            await self._stop_loss_buy(kind, ask_exchange, bid_exchange, ask, bid, -diff_num, buy_ret['order_id'])
+        if error is not None:
+            raise error
+
+    async def _stop_loss_sell(self, kind, ask_exchange, bid_exchange, ask, bid, num, order_id):
+        price = ask[0] + ask[0] * (self.get_exchange_fee_rate(bid[0], ask_exchange, bid_exchange) + 0.002)  # 加 0.2%的滑点
         if num < (self.get_min_buy_num_limit(price) * 0.80):
             # TODO 导致 base coin 一直增加,是否考虑直接市价卖了,但有些市场又不支持市价交易接口
-            logger.debug("%s sell_order order_id %s lt limit %s", kind, ret['order_id'], num)
+            logger.debug("%s sell_order order_id %s lt limit %s", kind, order_id, num)
             return
         ret = await self.new_order(kind, 'sell', bid_exchange, price, num, False)
         logger.debug("%s stop loss order id %s num %s stop price %s ask price %s", kind, ret['order_id'], num, price, ask[0])
@@ -334,98 +508,174 @@ class Bricklayer(object):
             return
         # TODO 部分成交导致币数变少,所以简单处理,挂到直到成交为止.或人工介入,或市价卖了
 
-    async def new_order(self, kind, trade_type, exchange, price, num, cancel_sell_order=True):
+    async def _stop_loss_buy(self, kind, ask_exchange, bid_exchange, ask, bid, num, order_id):
+        price = bid[0] - bid[0] * (self.get_exchange_fee_rate(bid[0], ask_exchange, bid_exchange) + 0.002)  # 减 0.2%的滑点
+        if num < (self.get_min_buy_num_limit(price) * 0.80):
+            logger.debug("%s buy_order order_id %s lt limit %s", kind, order_id, num)
+            return
+        ret = await self.new_order(kind, 'buy', ask_exchange, price, num, False)
+        logger.debug("%s stop loss order id %s num %s stop price %s bid price %s", kind, ret['order_id'], num, price, bid[0])
+
+    # 市场熔断, 深度正在重新同步或太久没有更新时不能交易, 返回原因
+    def _get_unavailable_reason(self, ask_exchange, bid_exchange, now):
+        for exchange in (ask_exchange, bid_exchange):
+            if breaker.is_suspended(exchange):
+                return 'breaker_open'
+            if self.venue_retry_at.get(exchange.id, 0) > now:
+                return 'venue_error'
+            book = bookstore.ORDER_BOOKS.get((exchange.id, self.config.symbol))
+            if book is None:
+                continue
+            if book.is_resyncing():
+                return 'book_resyncing'
+            if book.is_crossed():
+                return 'book_crossed'
+            age = book.get_age(now)
+            if self.config.max_book_age > 0 and age is not None and age > self.config.max_book_age:
+                metrics.counter('leek_book_stale_total', exchange=exchange.id, symbol=self.config.symbol).inc()
+                return 'stale_book'
+        return None
+
+    def _skip(self, reason):
+        metrics.counter('leek_skips_total', name=self.config.name, reason=reason).inc()
+
+    def _journal_decision(self, reason, ask_exchange, bid_exchange, ask, bid, premium_rate, fee_rate=float('nan'), pure_profit=float('nan'),
+                          num=float('nan')):
+        if self.journal is not None:
+            self.journal.record_decision(self.config.name, reason, ask_exchange.id, bid_exchange.id, ask, bid, premium_rate, fee_rate,
+                                         pure_profit, num, self.trade_id if reason == 'trade' else 0)
+
+    def _observe_tick(self, metric_name, ask_exchange, bid_exchange, now):
+        # 以两个市场中最近收到的 ws 消息作为本次计算的行情时间
+        tick = None
+        for exchange in (ask_exchange, bid_exchange):
+            received_at = self.tick_at.get(exchange.id)
+            if received_at is not None and (tick is None or received_at > tick[0]):
+                tick = (received_at, exchange.id)
+        if tick is not None:
+            metrics.histogram(metric_name, exchange=tick[1]).observe(now - tick[0])
+
+    def _record_leg_skew(self, kind, buy_ret, sell_ret):
+        # 两单交易所确认下单的时间差
+        skew = abs(sell_ret['acked_at'] - buy_ret['acked_at'])
+        self.leg_skews.append(skew)
+        logger.debug("%s leg skew %.6f buy_order %s sell_order %s", kind, skew, buy_ret['order_id'], sell_ret['order_id'])
+
+    async def new_order(self, kind, trade_type, exchange, price, num, cancel_order=True):
         order = None
         success = False
         logger.debug("%s create_%s_order num %s price %s", kind, trade_type, num, price)
+        submitted_at = time.time()
         if trade_type == 'buy':
-            order = await exchange.create_limit_buy_order(self.config.symbol, num, price)
+            order = await scheduler.call(exchange, scheduler.PRIORITY_TRADE, 'create_limit_buy_order', self.config.symbol, num, price)
         else:
-            order = await exchange.create_limit_sell_order(self.config.symbol, num, price)
+            order = await scheduler.call(exchange, scheduler.PRIORITY_TRADE, 'create_limit_sell_order', self.config.symbol, num, price)
+        acked_at = time.time()
         logger.debug("%s %s_order resp %s", kind, trade_type, order)
 
-        await asyncio.sleep(1)  # bibox 下单后有时不能马上查询到
-
-        if 'status' not in order:
-            order = await self._fetch_order(exchange, order['id'], self.config.symbol, num)
-            logger.debug("%s %s_order resp %s", kind, trade_type, order)
-
+        metrics.histogram('leek_order_ack_seconds', exchange=exchange.id, side=trade_type).observe(acked_at - submitted_at)
+
+        order = await order_tracker.get_order_tracker(exchange).wait(order, self.config.symbol, num, self.config.order_timeout)
+        # 超时后仍没有查到最终状态 (没有 status 或一直查不到订单) 时当作挂单处理, 撤单后按交易所余额校对
+        status_unknown = order.get('status') is None
+        if order.get('status') not in order_tracker.DONE_STATUSES:
+            order = dict(order, status='open', filled=order.get('filled') or 0.0)
+            if order.get('remaining') is None:
+                order['remaining'] = num - order['filled']
+        confirmed_at = time.time()
+        metrics.counter('leek_orders_total', exchange=exchange.id, side=trade_type, status=order['status']).inc()
+        if order['filled']:
+            metrics.histogram('leek_order_fill_seconds', exchange=exchange.id, side=trade_type).observe(confirmed_at - submitted_at)
         logger.debug("%s %s_order %s filled %s", kind, trade_type, order['id'], order['filled'])
         if order['status'] == 'closed':
             logger.debug("%s %s_order %s status closed", kind, trade_type, order['id'])
             success = True
-            return {"success": success, "filled_num": order['filled'], "remaining_num": order['remaining'], "order_id": order['id']}
-
-        for i in range(1, 4):
-            await asyncio.sleep(i)
-            order = await self._fetch_order(exchange, order['id'], self.config.symbol, num)
-            if order['status'] == 'closed':
-                logger.debug("%s %s_order %s status closed", kind, trade_type, order['id'])
-                success = True
-                return {"success": success, "filled_num": order['filled'], "remaining_num": order['remaining'], "order_id": order['id']}
-            if i == 3:
-                if order['status'] == 'open':
-                    if trade_type == 'buy' or cancel_sell_order:
-                        resp = await exchange.cancel_order(order['id'], self.config.symbol)
-                        logger.debug("%s %s_order %s cancel_order resp %s", kind, trade_type, order['id'], resp)
-                        # 有可能存在数值差,刚好已经成交了,但在 ccxt 有些市场不支持获取非 open status 的订单,所以只能取老的值
-        return {"success": success, "filled_num": order['filled'], "remaining_num": order['remaining'], "order_id": order['id']}
-
-    async def _fetch_order(self, exchange, order_id, order_symbol, num):
-        if exchange.has['fetchOrder']:
-            return await exchange.fetch_order(order_id, order_symbol)
-        orders = await exchange.fetch_open_orders(symbol=order_symbol)
-        orders = [order for order in orders if order['id'] == order_id]
-        if len(orders) == 0:
-            return {'id': order_id, 'filled': num, 'remaining': 0.0, 'status': 'closed'}
-        return orders[0]
+        elif order['status'] == 'open' and cancel_order:
+            try:
+                resp = await scheduler.call(exchange, scheduler.PRIORITY_TRADE, 'cancel_order', order['id'], self.config.symbol)
+                logger.debug("%s %s_order %s cancel_order resp %s", kind, trade_type, order['id'], resp)
+            except ccxt.OrderNotFound as e:
+                # 已经成交或撤销, 以余额校对为准
+                logger.warning("%s %s_order %s cancel_order not found %s", kind, trade_type, order['id'], e)
+                status_unknown = True
+            # 有可能存在数值差,刚好已经成交了,但在 ccxt 有些市场不支持获取非 open status 的订单,所以只能取老的值
+        if self.journal is not None:
+            status = 'canceled' if order['status'] == 'open' and cancel_order else order['status']
+            self.journal.record_order(self.config.name, trade_type, exchange.id, order['id'], status, price, num, order['filled'] or 0.0,
+                                      order['remaining'] or 0.0, self.trade_id)
+        locked_num = order['remaining'] if order['status'] == 'open' and not cancel_order else 0.0
+        self.ledger.apply_fill(exchange, self.config.base_coin, self.config.quote_coin, trade_type, order['filled'] or 0.0,
+                               order.get('average') or price, self._get_taker_fee(exchange), locked_num or 0.0)
+        if status_unknown:
+            await self.update_balance()
+        return self._order_result(order, success, submitted_at, acked_at)
+
+    # 下单抛出异常的一单
+    def _failed_order_result(self, num):
+        return {"success": False, "filled_num": 0.0, "remaining_num": num, "order_id": None}
+
+    def _order_result(self, order, success, submitted_at, acked_at):
+        return {"success": success, "filled_num": order['filled'], "remaining_num": order['remaining'], "order_id": order['id'],
+                "submitted_at": submitted_at, "acked_at": acked_at}
 
     def get_last_ask(self, asks, idx=0):
         # 卖单价越低越靠前
         return asks.peekitem(idx)
 
-    def get_best_ask(self, asks, max_level=5):
-        # price ,number
-        ask = [0.0, 0.0]
-        a_max_level = max_level if max_level <= len(asks) else len(asks)
-        for i in range(0, a_max_level):
-            a_ask = self.get_last_ask(asks, i)
-            ask[0] = a_ask[0]
-            ask[1] += a_ask[1]
-            if ask[1] >= self.get_min_buy_num_limit(ask[0]):
-                break
-        return ask
+    def get_best_ask(self, asks):
+        # price, number, vwap
+        return self._get_best_fill(asks)
 
     def get_last_bid(self, bids, idx=-1):
         # 买单价越高越靠后
         return bids.peekitem(idx)
 
-    def get_best_bid(self, bids, max_level=5):
-        # price ,number
-        bid = [0.0, 0.0]
-        a_max_level = max_level if max_level <= len(bids) else len(bids)
-        for i in range(1, a_max_level + 1):
-            a_bid = self.get_last_bid(bids, -i)
-            bid[0] = a_bid[0]
-            bid[1] += a_bid[1]
-            if bid[1] >= self.get_min_buy_num_limit(bid[0]):
-                break
-        return bid
+    def get_best_bid(self, bids):
+        # price, number, vwap
+        return self._get_best_fill(bids)
+
+    def _get_best_fill(self, book_side):
+        # 吃到最小交易金额为止,不限档位
+        fill = book_side.fill_by_quote(self.config.min_buy_num_limit_by_quote)
+        if fill is None:
+            return [0.0, 0.0, 0.0]
+        return [fill[0], fill[1], fill[2]]
+
+    def _get_open_order_num(self, exchange):
+        if exchange is self.exchange1:
+            return self.exchange1_open_order_num
+        return self.exchange2_open_order_num
+
+    def _get_taker_fee(self, exchange):
+        if exchange is self.exchange1:
+            return self.config.exchange1_taker_fee
+        return self.config.exchange2_taker_fee
+
+    # 两个市场的手续费相加,和方向无关, ask_exchange/bid_exchange 留给多市场时区分
+    def _get_taker_fees(self, ask_exchange=None, bid_exchange=None):
+        return self.config.exchange1_taker_fee, self.config.exchange2_taker_fee
+
+    def _get_withdraw_fees(self, ask_exchange=None, bid_exchange=None):
+        return (max(self.config.exchange1_withdraw_base_fee, self.config.exchange2_withdraw_base_fee),
+                max(self.config.exchange1_withdraw_quote_fee, self.config.exchange2_withdraw_quote_fee))
 
     # 不跨交易转帐,交易手续费率, 大概的预估,不是准确的
-    def get_exchange_fee_rate(self, quote_price):
+    def get_exchange_fee_rate(self, quote_price, ask_exchange=None, bid_exchange=None):
         # 吃单费用,两个市场一般币数各一半,所以除以2
         bisect_coin_num = 2 if self.config.bisect_coin else 1
-        buy_fee = self.config.base_coin_num / bisect_coin_num * self.config.exchange1_taker_fee * quote_price
-        sell_fee = self.config.base_coin_num / bisect_coin_num * self.config.exchange2_taker_fee * quote_price
+        buy_taker_fee, sell_taker_fee = self._get_taker_fees(ask_exchange, bid_exchange)
+        buy_fee = self.config.base_coin_num / bisect_coin_num * buy_taker_fee * quote_price
+        sell_fee = self.config.base_coin_num / bisect_coin_num * sell_taker_fee * quote_price
         return (buy_fee + sell_fee) / (self.config.base_coin_num / bisect_coin_num * quote_price)
 
     # 跨交易转帐,交易手续费率, 大概的预估,不是准确的
-    def get_cross_exchange_fee_rate(self, quote_price):
+    def get_cross_exchange_fee_rate(self, quote_price, ask_exchange=None, bid_exchange=None):
         # 吃单费用,两个市场一般币数各一半,所以除以2
         bisect_coin_num = 2 if self.config.bisect_coin else 1
-        buy_fee = self.config.base_coin_num / bisect_coin_num * self.config.exchange1_taker_fee * quote_price
-        sell_fee = self.config.base_coin_num / bisect_coin_num * self.config.exchange2_taker_fee * quote_price
-        base_coin_withdraw_fee = max(self.config.exchange1_withdraw_base_fee, self.config.exchange2_withdraw_base_fee) * quote_price
-        quote_coin_withdraw_fee = max(self.config.exchange1_withdraw_quote_fee, self.config.exchange2_withdraw_quote_fee)
+        buy_taker_fee, sell_taker_fee = self._get_taker_fees(ask_exchange, bid_exchange)
+        withdraw_base_fee, withdraw_quote_fee = self._get_withdraw_fees(ask_exchange, bid_exchange)
+        buy_fee = self.config.base_coin_num / bisect_coin_num * buy_taker_fee * quote_price
+        sell_fee = self.config.base_coin_num / bisect_coin_num * sell_taker_fee * quote_price
+        base_coin_withdraw_fee = withdraw_base_fee * quote_price
+        quote_coin_withdraw_fee = withdraw_quote_fee
         return (buy_fee + sell_fee + base_coin_withdraw_fee + quote_coin_withdraw_fee) / (self.config.base_coin_num / bisect_coin_num * quote_price)
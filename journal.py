@@ -0,0 +1,298 @@
+import os
+import glob
+import json
+import time
+import queue
+import atexit
+import itertools
+import threading
+import numpy as np
+from . import logutils
+
+logger = logutils.get_logger('leek-journal')
+
+# 套利决策和订单结果的二进制日志, 代替从 DEBUG 日志中解析溢价, 放弃原因和成交
+# 文件格式:
+#   文件头: MAGIC, 元数据 json 长度 (uint32), 元数据 json (含 RECORD_DTYPE), 补齐到 8 字节
+#   记录: 定长 RECORD_DTYPE, 小端, 只追加; 读取时直接 np.memmap, 最后一条不完整时忽略
+# 按 UTC 日期每天一个文件: {LEEK_JOURNAL_PATH}leek-journal-YYYYMMDD.bin
+MAGIC = b'LEEKJRNL'
+META_LENGTH = np.dtype('<u4')
+
+KIND_DECISION = 0
+KIND_ORDER = 1
+
+# 决策记录的结果, trade 为下单, 其他为放弃原因 (与 leek_skips_total 的 reason 一致)
+# 没有溢价之前的放弃 (empty_book, no_premium 之类) 每次深度变化都会出现, 只计入 metrics 不写日志
+REASONS = ('trade', 'open_order_limit', 'fee', 'profit_limit', 'order_num', 'quote_balance', 'base_balance')
+SIDES = ('buy', 'sell')
+# 其他状态记为 len(STATUSES)
+STATUSES = ('open', 'closed', 'canceled', 'expired', 'rejected')
+
+RECORD_DTYPE = np.dtype([
+    ('ts', '<f8'),
+    # 决策: 低买市场吃单价/数量, 高卖市场吃单价/数量, 溢价率, 手续费率, 纯利润率, 下单数量, 大概利润
+    ('ask_price', '<f8'),
+    ('ask_num', '<f8'),
+    ('bid_price', '<f8'),
+    ('bid_num', '<f8'),
+    ('premium', '<f8'),
+    ('fee_rate', '<f8'),
+    ('pure_profit', '<f8'),
+    ('num', '<f8'),
+    ('profit', '<f8'),
+    # 订单: 限价, 成交数量, 未成交数量
+    ('price', '<f8'),
+    ('filled', '<f8'),
+    ('remaining', '<f8'),
+    # 同一次套利的决策和订单 trade_id 相同, 0 表示没有下单
+    ('trade_id', '<u8'),
+    ('name', 'S32'),
+    ('ask_exchange', 'S16'),
+    ('bid_exchange', 'S16'),
+    ('order_id', 'S48'),
+    ('kind', '<u2'),
+    ('reason', '<u2'),
+    ('side', '<u2'),
+    ('status', '<u2'),
+])
+
+EMPTY_RECORD = np.zeros((), dtype=RECORD_DTYPE)
+
+JOURNALS = {}
+
+
+def get_day(ts):
+    return time.strftime('%Y%m%d', time.gmtime(ts))
+
+
+def get_path(prefix, day):
+    return f'{prefix}leek-journal-{day}.bin'
+
+
+def write_header(f):
+    meta_bytes = json.dumps({'dtype': RECORD_DTYPE.descr}).encode()
+    header = MAGIC + np.array(len(meta_bytes), dtype=META_LENGTH).tobytes() + meta_bytes
+    header += b'\0' * (-len(header) % 8)
+    f.write(header)
+
+
+class Journal(object):
+    # 记录先写入内存中的数组, 满 batch_size 条时交给后台线程写盘; 后台线程空闲 flush_interval 秒时把没写盘的记录也写出去
+    # 事件循环只复制内存, 不等待磁盘
+    def __init__(self, prefix, batch_size=4096, flush_interval=1.0, clock=time.time):
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.buffer = np.zeros(batch_size, dtype=RECORD_DTYPE)
+        self.size = 0
+        self.day = None
+        self.record_count = 0
+        self.trade_ids = itertools.count(1)
+        # 保护 buffer, size, day, 事件循环写记录和后台线程取走记录时都要持有
+        self.lock = threading.Lock()
+        # (day, bytes), None 表示停止
+        self.queue = queue.Queue()
+        self.thread = None
+        self.file_day = None
+        self.file = None
+
+    def next_trade_id(self):
+        return next(self.trade_ids)
+
+    def record_decision(self, name, reason, ask_exchange_id, bid_exchange_id, ask, bid, premium, fee_rate=np.nan, pure_profit=np.nan,
+                        num=np.nan, trade_id=0):
+        with self.lock:
+            item = self._next()
+            item['kind'] = KIND_DECISION
+            item['name'] = name.encode()
+            item['reason'] = REASONS.index(reason)
+            item['ask_exchange'] = ask_exchange_id.encode()
+            item['bid_exchange'] = bid_exchange_id.encode()
+            item['ask_price'] = ask[0]
+            item['ask_num'] = ask[1]
+            item['bid_price'] = bid[0]
+            item['bid_num'] = bid[1]
+            item['premium'] = premium
+            item['fee_rate'] = fee_rate
+            item['pure_profit'] = pure_profit
+            item['num'] = num
+            item['profit'] = num * ask[0] * pure_profit
+            item['trade_id'] = trade_id
+            self._added()
+
+    def record_order(self, name, side, exchange_id, order_id, status, price, num, filled, remaining, trade_id=0):
+        with self.lock:
+            item = self._next()
+            item['kind'] = KIND_ORDER
+            item['name'] = name.encode()
+            item['side'] = SIDES.index(side)
+            item['status'] = STATUSES.index(status) if status in STATUSES else len(STATUSES)
+            # 买单记在低买市场, 卖单记在高卖市场
+            if side == 'buy':
+                item['ask_exchange'] = exchange_id.encode()
+            else:
+                item['bid_exchange'] = exchange_id.encode()
+            item['order_id'] = str(order_id).encode()
+            item['price'] = price
+            item['num'] = num
+            item['filled'] = filled
+            item['remaining'] = remaining
+            item['trade_id'] = trade_id
+            self._added()
+
+    def _next(self):
+        now = self.clock()
+        day = get_day(now)
+        if day != self.day:
+            # 前一天的记录写到前一天的文件
+            self._submit()
+            self.day = day
+        # 清空上一批的数据, 返回的记录是 buffer 中的视图
+        self.buffer[self.size] = EMPTY_RECORD
+        item = self.buffer[self.size]
+        item['ts'] = now
+        return item
+
+    def _added(self):
+        self.size += 1
+        self.record_count += 1
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='leek-journal', daemon=True)
+            self.thread.start()
+        if self.size >= self.batch_size:
+            self._submit()
+
+    # 持有 lock 时调用
+    def _submit(self):
+        if self.size == 0:
+            return
+        self.queue.put((self.day, self.buffer[:self.size].tobytes()))
+        self.size = 0
+
+    def _run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                with self.lock:
+                    self._submit()
+                continue
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                self.queue.task_done()
+
+    def _write(self, day, data):
+        if day != self.file_day:
+            if self.file is not None:
+                self.file.close()
+            path = get_path(self.prefix, day)
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self.file = open(path, 'ab')
+            self.file_day = day
+            if self.file.tell() == 0:
+                write_header(self.file)
+        self.file.write(data)
+        self.file.flush()
+
+    # 等待已有的记录都写盘
+    def flush(self):
+        with self.lock:
+            self._submit()
+        if self.thread is not None:
+            self.queue.join()
+
+    def close(self):
+        self.flush()
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.file is not None and not self.file.closed:
+            self.file.close()
+        self.file_day = None
+
+
+# 设置环境变量 LEEK_JOURNAL_PATH (目录或文件名前缀, 和 APP_LOG_PATH 一样) 后才记录, 同一进程共用一个
+def get_journal():
+    prefix = os.environ.get('LEEK_JOURNAL_PATH')
+    if not prefix:
+        return None
+    if prefix not in JOURNALS:
+        JOURNALS[prefix] = Journal(prefix)
+    return JOURNALS[prefix]
+
+
+@atexit.register
+def close_journals():
+    for item in JOURNALS.values():
+        item.close()
+
+
+def read_meta(buf):
+    if bytes(buf[:len(MAGIC)]) != MAGIC:
+        raise RuntimeError("not a leek journal file")
+    offset = len(MAGIC)
+    meta_length = int(np.frombuffer(buf, dtype=META_LENGTH, count=1, offset=offset)[0])
+    offset += META_LENGTH.itemsize
+    meta = json.loads(bytes(buf[offset:offset + meta_length]))
+    offset += meta_length
+    offset += -offset % 8
+    return meta, offset
+
+
+def read_journal(path):
+    # 返回 RECORD_DTYPE 的结构化数组 (只读 memmap), 按列取值: records['premium']
+    with open(path, 'rb') as f:
+        header = f.read(64 * 1024)
+    meta, offset = read_meta(header)
+    dtype = np.dtype([(str(name), str(fmt)) for name, fmt in meta['dtype']])
+    if dtype != RECORD_DTYPE:
+        raise RuntimeError(f"{path} journal dtype mismatch")
+    num = (os.path.getsize(path) - offset) // dtype.itemsize
+    if num <= 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(num,))
+
+
+# 读取 [start, end) 时间范围内的记录, 按 name, kind, reason 过滤; 时间为 unix 时间戳, None 不限制
+def load(prefix=None, start=None, end=None, name=None, kind=None, reason=None):
+    if prefix is None:
+        prefix = os.environ.get('LEEK_JOURNAL_PATH', '/tmp/')
+    paths = sorted(glob.glob(get_path(glob.escape(prefix), '[0-9]' * 8)))
+    start_day = get_day(start) if start is not None else None
+    end_day = get_day(end) if end is not None else None
+    parts = []
+    for path in paths:
+        day = path[-12:-4]
+        if (start_day is not None and day < start_day) or (end_day is not None and day > end_day):
+            continue
+        records = read_journal(path)
+        mask = np.ones(len(records), dtype=bool)
+        if start is not None:
+            mask &= records['ts'] >= start
+        if end is not None:
+            mask &= records['ts'] < end
+        if name is not None:
+            mask &= records['name'] == name.encode()
+        if kind is not None:
+            mask &= records['kind'] == kind
+        if reason is not None:
+            mask &= records['reason'] == REASONS.index(reason)
+        parts.append(np.asarray(records[mask]))
+    if not parts:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.concatenate(parts)
+
+
+# {放弃原因: 次数}, 只统计决策记录
+def count_reasons(records):
+    decisions = records[records['kind'] == KIND_DECISION]
+    codes, counts = np.unique(decisions['reason'], return_counts=True)
+    return {REASONS[code]: int(count) for code, count in zip(codes.tolist(), counts.tolist())}
@@ -0,0 +1,64 @@
+from . import metrics
+
+
+# 本地余额账本, 成交后按成交数量和预估手续费直接更新, 定时全量获取余额只用于校对
+class BalanceLedger(object):
+    def __init__(self):
+        self.balances = {}
+        # 最近一次校对时交易所余额 - 本地余额
+        self.drifts = {}
+        self.fill_count = 0
+        self.reconcile_count = 0
+
+    def _key(self, exchange, coin):
+        return exchange.id, exchange.apiKey, coin
+
+    def get(self, exchange, coin):
+        return self.balances.get(self._key(exchange, coin), 0.0)
+
+    def reconcile(self, exchange, coin, num):
+        key = self._key(exchange, coin)
+        drift = num - self.balances[key] if key in self.balances else 0.0
+        self.balances[key] = num
+        self.drifts[key] = drift
+        self.reconcile_count += 1
+        return drift
+
+    # locked_num 为仍在挂单中的数量, 会冻结可用余额
+    def apply_fill(self, exchange, base_coin, quote_coin, trade_type, filled_num, price, fee_rate, locked_num=0.0):
+        base_key = self._key(exchange, base_coin)
+        quote_key = self._key(exchange, quote_coin)
+        base_num = self.balances.get(base_key, 0.0)
+        quote_num = self.balances.get(quote_key, 0.0)
+        if trade_type == 'buy':
+            base_num += filled_num * (1 - fee_rate)
+            quote_num -= (filled_num + locked_num) * price
+        else:
+            base_num -= filled_num + locked_num
+            quote_num += filled_num * price * (1 - fee_rate)
+        self.balances[base_key] = base_num
+        self.balances[quote_key] = quote_num
+        self.fill_count += 1
+
+    def get_drifts(self):
+        return {f'{exchange_id} {coin}': drift for (exchange_id, _, coin), drift in self.drifts.items()}
+
+
+# 同一进程所有 Bricklayer 共用一个账本, 共用 API Key 的套利对看到的是同一份余额
+LEDGER = BalanceLedger()
+
+
+def get_ledger():
+    return LEDGER
+
+
+def collect_metrics():
+    # 同一交易所多个 API Key 的偏差相加
+    drifts = {}
+    for (exchange_id, _, coin), drift in list(LEDGER.drifts.items()):
+        drifts[(exchange_id, coin)] = drifts.get((exchange_id, coin), 0.0) + drift
+    for (exchange_id, coin), drift in drifts.items():
+        metrics.gauge('leek_balance_drift', exchange=exchange_id, coin=coin).set(drift)
+
+
+metrics.add_collector(collect_metrics)
@@ -1,5 +1,76 @@
 import os
+import time
+import queue
+import atexit
 import logging
+import logging.handlers
+
+# 每个日志文件一个后台写线程, 事件循环线程只负责入队
+LISTENERS = []
+
+
+class BatchRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    # 按大小或时间切分日志, 每 flush_count 条或 flush_interval 秒才写盘一次
+    def __init__(self, filename, max_bytes=0, backup_count=0, rotate_interval=0, flush_count=200, flush_interval=1.0):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count)
+        self.rotate_interval = rotate_interval
+        self.rotate_at = time.time() + rotate_interval
+        self.flush_count = flush_count
+        self.flush_interval = flush_interval
+        self.pending_count = 0
+        self.flushed_at = time.time()
+
+    def shouldRollover(self, record):
+        if self.rotate_interval > 0 and time.time() >= self.rotate_at:
+            return 1
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rotate_at = time.time() + self.rotate_interval
+
+    # emit 每条日志后都会调用 flush, 这里只计数
+    def flush(self):
+        self.pending_count += 1
+        if self.pending_count >= self.flush_count or time.time() - self.flushed_at >= self.flush_interval:
+            self.force_flush()
+
+    def force_flush(self):
+        super().flush()
+        self.pending_count = 0
+        self.flushed_at = time.time()
+
+    def close(self):
+        self.force_flush()
+        super().close()
+
+
+class DropQueueHandler(logging.handlers.QueueHandler):
+    # 队列满时丢弃, 不阻塞事件循环
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped_count = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped_count += 1
+
+
+class BatchQueueListener(logging.handlers.QueueListener):
+    def __init__(self, log_queue, *handlers, flush_interval=1.0):
+        super().__init__(log_queue, *handlers)
+        self.flush_interval = flush_interval
+
+    # 队列空闲时把没写盘的日志刷出去
+    def dequeue(self, block):
+        while True:
+            try:
+                return self.queue.get(block, self.flush_interval)
+            except queue.Empty:
+                for handler in self.handlers:
+                    handler.force_flush()
 
 
 def get_logger(log_name):
@@ -7,8 +78,53 @@ def get_logger(log_name):
     logger.setLevel(logging.DEBUG)
     log_dir = os.environ.get('APP_LOG_PATH', '/tmp/')
     log_path = log_dir + log_name + '.log'
-    handler = logging.FileHandler(log_path)
+    handler = BatchRotatingFileHandler(log_path,
+                                       max_bytes=int(os.environ.get('APP_LOG_MAX_BYTES', 512 * 1024 * 1024)),
+                                       backup_count=int(os.environ.get('APP_LOG_BACKUP_COUNT', 5)),
+                                       rotate_interval=int(os.environ.get('APP_LOG_ROTATE_INTERVAL', 24 * 60 * 60)))
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(filename)s - %(lineno)s - %(levelname)s - %(message)s')
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    log_queue = queue.Queue(int(os.environ.get('APP_LOG_QUEUE_SIZE', 100000)))
+    logger.addHandler(DropQueueHandler(log_queue))
+    listener = BatchQueueListener(log_queue, handler)
+    listener.start()
+    LISTENERS.append(listener)
     return logger
+
+
+@atexit.register
+def stop_loggers():
+    while LISTENERS:
+        listener = LISTENERS.pop()
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+
+class SampledLogger(object):
+    # 重复的调试日志, 同一个 (msg, key) 每 interval 秒最多输出一次, 并带上期间跳过的条数
+    # interval 为 0 时不采样
+    def __init__(self, logger, interval=None):
+        self.logger = logger
+        if interval is None:
+            interval = float(os.environ.get('APP_LOG_SAMPLE_INTERVAL', 10))
+        self.interval = interval
+        self.states = {}
+
+    def debug(self, msg, *args, key=None):
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        if self.interval <= 0:
+            self.logger.debug(msg, *args, stacklevel=2)
+            return
+        key = (msg, key)
+        now = time.monotonic()
+        state = self.states.get(key)
+        if state is not None and now - state[0] < self.interval:
+            state[1] += 1
+            return
+        self.states[key] = [now, 0]
+        if state is not None and state[1] > 0:
+            self.logger.debug(msg + ' | skipped %s', *args, state[1], stacklevel=2)
+        else:
+            self.logger.debug(msg, *args, stacklevel=2)
@@ -0,0 +1,83 @@
+import os
+import json
+import time
+import asyncio
+from . import logutils
+
+logger = logutils.get_logger('leek-markets')
+
+# 交易所 id -> (markets, currencies), 同一个交易所的所有实例共用, 只下载一次
+MARKETS = {}
+# 正在下载的交易所 id -> future, 同时启动的 Bricklayer 等待同一次下载
+LOADINGS = {}
+
+
+def get_cache_path(exchange_id):
+    cache_dir = os.environ.get('LEEK_MARKETS_CACHE_PATH', '/tmp/leek-markets/')
+    return os.path.join(cache_dir, f'{exchange_id}.json')
+
+
+def get_cache_ttl():
+    # 秒, 0 不使用磁盘缓存
+    return float(os.environ.get('LEEK_MARKETS_CACHE_TTL', 6 * 60 * 60))
+
+
+def read_cache(exchange_id, ttl):
+    path = get_cache_path(exchange_id)
+    try:
+        if time.time() - os.path.getmtime(path) > ttl:
+            return None
+        with open(path) as f:
+            data = json.load(f)
+        return data['markets'], data['currencies']
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.exception(e)
+        return None
+
+
+def write_cache(exchange_id, markets, currencies):
+    path = get_cache_path(exchange_id)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 先写临时文件再改名, 其他进程不会读到写了一半的文件
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'markets': markets, 'currencies': currencies}, f, default=str)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logger.exception(e)
+
+
+async def _load(exchange, reload):
+    ttl = get_cache_ttl()
+    if ttl > 0 and not reload:
+        data = await asyncio.to_thread(read_cache, exchange.id, ttl)
+        if data is not None:
+            logger.debug("%s markets loaded from cache", exchange.id)
+            return data
+    await exchange.load_markets(reload)
+    data = (exchange.markets, exchange.currencies)
+    if ttl > 0:
+        await asyncio.to_thread(write_cache, exchange.id, data[0], data[1])
+    return data
+
+
+# 代替 exchange.load_markets(), 内存中已有则直接设置, 其次读磁盘缓存, 都没有才从交易所下载
+async def load_markets(exchange, reload=False):
+    if reload:
+        MARKETS.pop(exchange.id, None)
+    if exchange.id not in MARKETS:
+        future = LOADINGS.get(exchange.id)
+        if future is None:
+            future = asyncio.ensure_future(_load(exchange, reload))
+            LOADINGS[exchange.id] = future
+        try:
+            MARKETS[exchange.id] = await future
+        finally:
+            if LOADINGS.get(exchange.id) is future:
+                del LOADINGS[exchange.id]
+    markets, currencies = MARKETS[exchange.id]
+    exchange.set_markets(markets, currencies)
+    return exchange.markets
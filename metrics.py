@@ -0,0 +1,158 @@
+import os
+import asyncio
+from bisect import bisect_left
+from . import logutils
+
+logger = logutils.get_logger('leek-metrics')
+
+# 延迟直方图的桶上限, 秒
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# (名称, 标签) -> 指标, 同一进程内所有 Bricklayer 共用
+METRICS = {}
+METRIC_TYPES = {}
+# 输出前调用, 用于更新深度档位, 深度延迟之类只在查看时才计算的 gauge
+COLLECTORS = []
+
+
+class Counter(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, num=1):
+        self.value += num
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+
+class Gauge(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+
+class Histogram(object):
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        result = []
+        cum_count = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            cum_count += count
+            result.append((name + '_bucket', labels + (('le', repr(bucket)),), cum_count))
+        result.append((name + '_bucket', labels + (('le', '+Inf'),), self.count))
+        result.append((name + '_sum', labels, self.sum))
+        result.append((name + '_count', labels, self.count))
+        return result
+
+
+# 标签里可能有 name, 所以指标名参数叫 metric_name
+def _get_metric(metric_type, metric_name, labels):
+    key = (metric_name, tuple(sorted(labels.items())))
+    metric = METRICS.get(key)
+    if metric is None:
+        if METRIC_TYPES.setdefault(metric_name, metric_type) is not metric_type:
+            raise RuntimeError(f"metric {metric_name} is not a {metric_type.__name__}")
+        metric = metric_type()
+        METRICS[key] = metric
+    return metric
+
+
+def counter(metric_name, **labels):
+    return _get_metric(Counter, metric_name, labels)
+
+
+def gauge(metric_name, **labels):
+    return _get_metric(Gauge, metric_name, labels)
+
+
+def histogram(metric_name, **labels):
+    return _get_metric(Histogram, metric_name, labels)
+
+
+def add_collector(func):
+    COLLECTORS.append(func)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    items = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        items.append(f'{key}="{value}"')
+    return '{' + ','.join(items) + '}'
+
+
+# Prometheus 文本格式
+def render():
+    for func in COLLECTORS:
+        try:
+            func()
+        except Exception as e:
+            logger.exception(e)
+    lines = []
+    for name in sorted(METRIC_TYPES):
+        lines.append(f'# TYPE {name} {METRIC_TYPES[name].__name__.lower()}')
+        for (metric_name, labels), metric in list(METRICS.items()):
+            if metric_name != name:
+                continue
+            for sample_name, sample_labels, value in metric.samples(name, labels):
+                lines.append(f'{sample_name}{_format_labels(sample_labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+async def _handle(reader, writer):
+    try:
+        # 只有一个页面, 不解析请求
+        await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=5)
+        body = render().encode()
+        writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\n\r\n' % len(body))
+        writer.write(body)
+        await writer.drain()
+    except Exception as e:
+        logger.debug("metrics request error %s", e)
+    finally:
+        writer.close()
+
+
+SERVER = None
+
+
+# 本机 http 文本接口, 设置环境变量 LEEK_METRICS_PORT 后启动, curl http://127.0.0.1:port/ 查看
+async def start_server(host=None, port=None):
+    global SERVER
+    if SERVER is not None:
+        return await SERVER
+    if port is None:
+        port = os.environ.get('LEEK_METRICS_PORT')
+        if not port:
+            return None
+    if host is None:
+        host = os.environ.get('LEEK_METRICS_HOST', '127.0.0.1')
+    # 多个 Bricklayer 同时启动时只监听一次
+    SERVER = asyncio.ensure_future(asyncio.start_server(_handle, host, int(port)))
+    server = await SERVER
+    logger.info("metrics server listening on %s:%s", host, port)
+    return server
@@ -0,0 +1,278 @@
+import asyncio
+import heapq
+import random
+import time
+from collections import deque
+from . import bookstore
+from . import breaker
+from . import journal
+from . import ledger
+from . import logutils
+from . import markets
+from . import metrics
+from . import orderbook
+from . import scheduler
+from . import utils
+from .bricklayer import Bricklayer
+
+logger = logutils.get_logger('leek-multi-bricklayer')
+
+
+class Venue(object):
+    def __init__(self, index, exchange, config, order_book_depth, balance_ledger, base_coin, quote_coin):
+        self.index = index
+        self.exchange = exchange
+        self.config = config
+
+        self.ledger = balance_ledger
+        self.base_coin = base_coin
+        self.quote_coin = quote_coin
+        self.open_order_num = 0
+        self.base_coin_alerted = False
+        self.quote_coin_alerted = False
+
+        self.book = None
+        self.asks = orderbook.OrderBookSide(max_depth=order_book_depth)
+        self.bids = orderbook.OrderBookSide(is_bids=True, max_depth=order_book_depth)
+        # 最优价变化时版本号加一, 堆里版本号不一致的是过期数据
+        self.best_ask = None
+        self.best_bid = None
+        self.ask_version = 0
+        self.bid_version = 0
+
+    @property
+    def base_coin_balance(self):
+        return self.ledger.get(self.exchange, self.base_coin)
+
+    @property
+    def quote_coin_balance(self):
+        return self.ledger.get(self.exchange, self.quote_coin)
+
+
+# 一个交易对, N 个市场. 每个市场一份深度和余额, 用最优卖价小顶堆和最优买价大顶堆找出价差最大的两个市场
+class MultiBricklayer(Bricklayer):
+    def __init__(self, config):
+        self.config = config
+        self.ledger = ledger.get_ledger()
+        self.venues = []
+        for index, venue_config in enumerate(config.exchanges):
+            options = {'apiKey': venue_config.api_key, 'secret': venue_config.secret}
+            if venue_config.password is not None:
+                options['password'] = venue_config.password
+            exchange = utils.get_exchange(venue_config.id, options)
+            self.venues.append(Venue(index, exchange, venue_config, config.order_book_depth, self.ledger, config.base_coin, config.quote_coin))
+        self.venues_by_id = {venue.exchange.id: venue for venue in self.venues}
+
+        self.ask_heap = []
+        self.bid_heap = []
+
+        self.is_ready = False
+        self.order_book_event = asyncio.Event()
+        self.evaluated_tops = {}
+        self.tick_at = {}
+        self.leg_skews = deque(maxlen=1000)
+        self.venue_retry_at = {}
+        self.journal = journal.get_journal()
+        self.trade_id = 0
+
+    async def balance_alert(self):
+        for venue in self.venues:
+            if venue.base_coin_alerted:
+                if venue.base_coin_balance >= self.config.base_coin_alert_num:
+                    venue.base_coin_alerted = False
+            else:
+                if venue.base_coin_balance < self.config.base_coin_alert_num:
+                    self.balance_alert_notice(venue.exchange.id, self.config.base_coin, venue.base_coin_balance)
+                    venue.base_coin_alerted = True
+            if venue.quote_coin_alerted:
+                if venue.quote_coin_balance >= self.config.quote_coin_alert_num:
+                    venue.quote_coin_alerted = False
+            else:
+                if venue.quote_coin_balance < self.config.quote_coin_alert_num:
+                    venue.quote_coin_alerted = True
+                    self.balance_alert_notice(venue.exchange.id, self.config.quote_coin, venue.quote_coin_balance)
+
+    async def update_balance(self):
+        try:
+            datas = await asyncio.gather(*[scheduler.call(venue.exchange, scheduler.PRIORITY_REFRESH, 'fetch_balance') for venue in self.venues],
+                                         return_exceptions=True)
+            for venue, data in zip(self.venues, datas):
+                if isinstance(data, Exception):
+                    logger.warning("%s %s fetch_balance failed %r", self.config.symbol, venue.exchange.id, data)
+                    continue
+                self._reconcile_balance(self.config.symbol, venue.exchange, data)
+                logger.debug("%s %s balance | base_coin_balance %s | quote_coin_balance %s",
+                             self.config.symbol, venue.exchange.id, venue.base_coin_balance, venue.quote_coin_balance)
+            self.evaluated_tops.clear()
+        except Exception as e:
+            logger.exception(e)
+
+    async def update_open_orders(self):
+        try:
+            datas = await asyncio.gather(*[scheduler.call(venue.exchange, scheduler.PRIORITY_REFRESH, 'fetch_open_orders', symbol=self.config.symbol)
+                                           for venue in self.venues], return_exceptions=True)
+            for venue, data in zip(self.venues, datas):
+                if isinstance(data, Exception):
+                    logger.warning("%s %s fetch_open_orders failed %r", self.config.symbol, venue.exchange.id, data)
+                    continue
+                venue.open_order_num = len(data)
+            self.evaluated_tops.clear()
+        except Exception as e:
+            logger.exception(e)
+
+    async def update_order_book(self):
+        for venue in self.venues:
+            venue.book = bookstore.get_order_book(venue.exchange, self.config.symbol, self._get_venue_ws_callback(venue),
+                                                  venue.config.new_ws, self.config.order_book_depth)
+            venue.asks = venue.book.asks
+            venue.bids = venue.book.bids
+
+    def _get_venue_ws_callback(self, venue):
+        def callback(data):
+            self.tick_at[venue.exchange.id] = venue.book.received_at
+            # 深度交叉时不计算, 恢复后的下一条增量再更新
+            if not venue.book.is_crossed():
+                self._venue_order_book_changed(venue)
+        return callback
+
+    def _venue_order_book_changed(self, venue):
+        best_ask = venue.asks.best()[0] if venue.asks else None
+        best_bid = venue.bids.best()[0] if venue.bids else None
+        if best_ask == venue.best_ask and best_bid == venue.best_bid:
+            return
+        if best_ask != venue.best_ask:
+            venue.best_ask = best_ask
+            venue.ask_version += 1
+            if best_ask is not None:
+                heapq.heappush(self.ask_heap, (best_ask, venue.ask_version, venue.index))
+        if best_bid != venue.best_bid:
+            venue.best_bid = best_bid
+            venue.bid_version += 1
+            if best_bid is not None:
+                heapq.heappush(self.bid_heap, (-best_bid, venue.bid_version, venue.index))
+        if len(self.ask_heap) + len(self.bid_heap) > 8 * len(self.venues):
+            self._rebuild_heaps()
+        self.order_book_event.set()
+
+    def _rebuild_heaps(self):
+        self.ask_heap = [(venue.best_ask, venue.ask_version, venue.index) for venue in self.venues if venue.best_ask is not None]
+        self.bid_heap = [(-venue.best_bid, venue.bid_version, venue.index) for venue in self.venues if venue.best_bid is not None]
+        heapq.heapify(self.ask_heap)
+        heapq.heapify(self.bid_heap)
+
+    def _peek_heap(self, heap, version_name, skip_top=False):
+        # 熔断中, 深度不可用, 或余额和挂单数不够下单的市场不参与套利, 先取出, 查完再放回
+        skipped = []
+        while heap:
+            venue = self.venues[heap[0][2]]
+            if heap[0][1] != getattr(venue, version_name):
+                heapq.heappop(heap)
+            elif self._is_venue_suspended(venue) or not self._is_venue_tradable(venue, version_name == 'ask_version'):
+                skipped.append(heapq.heappop(heap))
+            else:
+                break
+        if not heap:
+            item = None
+        elif not skip_top:
+            item = heap[0]
+        else:
+            top = heapq.heappop(heap)
+            item = self._peek_heap(heap, version_name)
+            heapq.heappush(heap, top)
+        for skipped_item in skipped:
+            heapq.heappush(heap, skipped_item)
+        return item
+
+    # is_buy: 在该市场低买, 需要报价币; 否则高卖, 需要基本币. 与 _buy_low_and_sell_high 的检查一致, 按本市场最优价估算
+    def _is_venue_tradable(self, venue, is_buy):
+        if venue.open_order_num >= self.config.max_open_order_limit:
+            return False
+        if is_buy:
+            return venue.quote_coin_balance * 0.97 >= self.config.min_buy_num_limit_by_quote
+        return venue.base_coin_balance * venue.best_bid >= self.config.min_buy_num_limit_by_quote
+
+    def _is_venue_suspended(self, venue):
+        if breaker.is_suspended(venue.exchange):
+            return True
+        if self.venue_retry_at.get(venue.exchange.id, 0) > time.time():
+            return True
+        if venue.book is None:
+            return False
+        if venue.book.is_resyncing() or venue.book.is_crossed():
+            return True
+        age = venue.book.get_age()
+        return self.config.max_book_age > 0 and age is not None and age > self.config.max_book_age
+
+    def find_best_pair(self):
+        # 返回 (低买市场, 高卖市场)
+        ask_item = self._peek_heap(self.ask_heap, 'ask_version')
+        bid_item = self._peek_heap(self.bid_heap, 'bid_version')
+        if ask_item is None or bid_item is None:
+            return None
+        if ask_item[2] != bid_item[2]:
+            return self.venues[ask_item[2]], self.venues[bid_item[2]]
+        # 最优卖价和最优买价在同一个市场, 取其中一边的次优市场
+        second_ask_item = self._peek_heap(self.ask_heap, 'ask_version', True)
+        second_bid_item = self._peek_heap(self.bid_heap, 'bid_version', True)
+        if second_ask_item is None and second_bid_item is None:
+            return None
+        if second_bid_item is None or (second_ask_item is not None and
+                                       -bid_item[0] / second_ask_item[0] >= -second_bid_item[0] / ask_item[0]):
+            return self.venues[second_ask_item[2]], self.venues[bid_item[2]]
+        return self.venues[ask_item[2]], self.venues[second_bid_item[2]]
+
+    async def move_brick(self):
+        while True:
+            if utils.exit_signal:
+                print("catch exit_signal")
+                break
+            await self._wait_order_book_changed()
+            pair = self.find_best_pair()
+            if pair is None:
+                continue
+            ask_venue, bid_venue = pair
+            if not self._is_tops_changed((ask_venue.index, bid_venue.index), ask_venue.asks, bid_venue.bids):
+                continue
+            try:
+                await self._buy_low_and_sell_high(ask_venue.exchange, ask_venue.asks, ask_venue.bids, bid_venue.exchange, bid_venue.asks,
+                                                  bid_venue.bids, ask_venue.quote_coin_balance, bid_venue.base_coin_balance,
+                                                  self.config.pure_profit_limit)
+            except Exception as e:
+                await self._move_brick_exception(e)
+
+    async def start(self):
+        await metrics.start_server()
+        for venue in self.venues:
+            venue.exchange.checkRequiredCredentials()
+            self._check_exchange_api_support(venue.exchange)
+
+        while True:
+            try:
+                await asyncio.gather(*[markets.load_markets(venue.exchange) for venue in self.venues])
+                await asyncio.gather(self.update_balance(), self.update_open_orders())
+                self.is_ready = True
+                break
+            except Exception as e:
+                logger.exception(e)
+                await asyncio.sleep(random.randint(1, 3))
+
+        await self.update_order_book()
+
+        asyncio.create_task(self._timer_tasks())
+
+        await self._wait_order_book_ready([venue.book for venue in self.venues])
+
+    def _get_open_order_num(self, exchange):
+        return self.venues_by_id[exchange.id].open_order_num
+
+    def _get_taker_fee(self, exchange):
+        return self.venues_by_id[exchange.id].config.taker_fee
+
+    def _get_taker_fees(self, ask_exchange=None, bid_exchange=None):
+        return self.venues_by_id[ask_exchange.id].config.taker_fee, self.venues_by_id[bid_exchange.id].config.taker_fee
+
+    def _get_withdraw_fees(self, ask_exchange=None, bid_exchange=None):
+        ask_config = self.venues_by_id[ask_exchange.id].config
+        bid_config = self.venues_by_id[bid_exchange.id].config
+        return (max(ask_config.withdraw_base_fee, bid_config.withdraw_base_fee),
+                max(ask_config.withdraw_quote_fee, bid_config.withdraw_quote_fee))
@@ -0,0 +1,143 @@
+import asyncio
+import time
+import ccxt
+from . import logutils
+from . import scheduler
+
+logger = logutils.get_logger('leek-order-tracker')
+
+# 同一个 API Key 的挂单共用一个 tracker, 每轮查询合并成一次请求
+ORDER_TRACKERS = {}
+
+DONE_STATUSES = ('closed', 'canceled', 'expired', 'rejected')
+
+
+class TrackedOrder(object):
+    def __init__(self, order, symbol, num, interval):
+        self.order = order
+        self.symbol = symbol
+        self.num = num
+        self.created_at = time.time()
+        self.interval = interval
+        self.next_check_at = self.created_at + interval
+        self.done = asyncio.get_running_loop().create_future()
+
+    def update(self, order):
+        self.order = order
+        if order['status'] in DONE_STATUSES and not self.done.done():
+            self.done.set_result(order)
+
+
+class OrderTracker(object):
+    # 有私有 ws 订单推送 (watchOrders) 时用推送, 否则按指数退避轮询, 轮询间隔 min_interval 到 max_interval
+    # 不支持 fetchOrder 的市场, 同一轮所有挂单只调用一次 fetch_open_orders
+    # first_query_delay: 有些市场 (bibox) 下单后不能马上查到, 此时间内在挂单列表中找不到不当作已成交
+    def __init__(self, exchange, min_interval=0.2, max_interval=2.0, backoff=1.5, first_query_delay=1.0):
+        self.exchange = exchange
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.first_query_delay = first_query_delay
+        self.orders = {}
+        self.wakeup = asyncio.Event()
+        self.poll_task = None
+        self.watch_tasks = {}
+
+    def is_watch_supported(self):
+        return bool(self.exchange.has.get('watchOrders')) and hasattr(self.exchange, 'watch_orders')
+
+    async def wait(self, order, symbol, num, timeout):
+        # 等待订单结束或超时, 返回最后一次查到的订单
+        if order.get('status') in DONE_STATUSES:
+            return order
+        watching = self.is_watch_supported()
+        tracked = TrackedOrder(order, symbol, num, self.max_interval if watching else self.min_interval)
+        self.orders[order['id']] = tracked
+        if watching and symbol not in self.watch_tasks:
+            self.watch_tasks[symbol] = asyncio.create_task(self._watch(symbol))
+        if self.poll_task is None:
+            self.poll_task = asyncio.create_task(self._poll())
+        self.wakeup.set()
+        try:
+            await asyncio.wait_for(asyncio.shield(tracked.done), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.orders.pop(order['id'], None)
+        if not tracked.done.done():
+            # 超时后最后再查一次
+            await self._check([tracked], True)
+        return tracked.order
+
+    async def _poll(self):
+        try:
+            while self.orders:
+                now = time.time()
+                next_check_at = min(tracked.next_check_at for tracked in self.orders.values())
+                if next_check_at > now:
+                    self.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), next_check_at - now)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                due = [tracked for tracked in self.orders.values() if tracked.next_check_at <= now]
+                for tracked in due:
+                    tracked.interval = min(tracked.interval * self.backoff, self.max_interval)
+                    tracked.next_check_at = now + tracked.interval
+                try:
+                    await self._check(due)
+                except Exception as e:
+                    logger.exception(e)
+        finally:
+            self.poll_task = None
+
+    async def _check(self, trackeds, force=False):
+        if self.exchange.has['fetchOrder']:
+            results = await asyncio.gather(*[scheduler.call(self.exchange, scheduler.PRIORITY_ORDER_QUERY, 'fetch_order',
+                                                            tracked.order['id'], tracked.symbol) for tracked in trackeds],
+                                           return_exceptions=True)
+            for tracked, result in zip(trackeds, results):
+                if isinstance(result, ccxt.OrderNotFound):
+                    continue
+                if isinstance(result, Exception):
+                    raise result
+                tracked.update(result)
+            return
+        symbols = set(tracked.symbol for tracked in trackeds)
+        for symbol in symbols:
+            open_orders = await scheduler.call(self.exchange, scheduler.PRIORITY_ORDER_QUERY, 'fetch_open_orders', symbol=symbol)
+            open_orders = {order['id']: order for order in open_orders}
+            now = time.time()
+            # 同一交易对其他在途订单也顺便更新
+            for tracked in list(self.orders.values()) + trackeds:
+                if tracked.symbol != symbol:
+                    continue
+                order_id = tracked.order['id']
+                if order_id in open_orders:
+                    tracked.update(open_orders[order_id])
+                elif force or now - tracked.created_at >= self.first_query_delay:
+                    # 不在挂单列表中, 只能当作已全部成交
+                    tracked.update({'id': order_id, 'filled': tracked.num, 'remaining': 0.0, 'status': 'closed'})
+                else:
+                    tracked.next_check_at = min(tracked.next_check_at, tracked.created_at + self.first_query_delay)
+
+    async def _watch(self, symbol):
+        try:
+            while any(tracked.symbol == symbol for tracked in self.orders.values()):
+                orders = await self.exchange.watch_orders(symbol)
+                for order in orders:
+                    tracked = self.orders.get(order['id'])
+                    if tracked is not None:
+                        tracked.update(order)
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            self.watch_tasks.pop(symbol, None)
+
+
+def get_order_tracker(exchange):
+    key = (exchange.id, exchange.apiKey)
+    if key not in ORDER_TRACKERS:
+        ORDER_TRACKERS[key] = OrderTracker(exchange)
+    return ORDER_TRACKERS[key]
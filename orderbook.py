@@ -0,0 +1,157 @@
+from array import array
+from bisect import bisect_left
+
+
+class OrderBookSide(object):
+    # 和 SortedDict 一样按价格升序存储: asks 最优价在头部, bids 最优价在尾部
+    # 超过 max_depth 的远端档位直接丢弃,套利只关心靠前的档位
+    # cum_volumes/cum_notionals 是从最优价开始的累计数量和累计金额, 只算到查询需要的档位,
+    # 更新时只记录最靠前的变动档位 dirty, 查询时从 dirty 开始重算
+    __slots__ = ('is_bids', 'max_depth', 'prices', 'volumes', 'cum_volumes', 'cum_notionals', 'dirty')
+
+    def __init__(self, is_bids=False, max_depth=100):
+        self.is_bids = is_bids
+        self.max_depth = max_depth
+        self.prices = array('d')
+        self.volumes = array('d')
+        self.cum_volumes = array('d')
+        self.cum_notionals = array('d')
+        self.dirty = 0
+
+    def __len__(self):
+        return len(self.prices)
+
+    def __contains__(self, price):
+        i = bisect_left(self.prices, price)
+        return i < len(self.prices) and self.prices[i] == price
+
+    def __getitem__(self, price):
+        i = bisect_left(self.prices, price)
+        if i < len(self.prices) and self.prices[i] == price:
+            return self.volumes[i]
+        raise KeyError(price)
+
+    def __setitem__(self, price, volume):
+        prices = self.prices
+        i = bisect_left(prices, price)
+        if i < len(prices) and prices[i] == price:
+            self.volumes[i] = volume
+            self._mark_dirty(i, len(prices))
+            return
+        if len(prices) >= self.max_depth:
+            # 比现有最差档还差,插入后也会被丢弃
+            if self.is_bids:
+                if i == 0:
+                    return
+                del prices[0]
+                del self.volumes[0]
+                i -= 1
+            else:
+                if i == len(prices):
+                    return
+                prices.pop()
+                self.volumes.pop()
+        prices.insert(i, price)
+        self.volumes.insert(i, volume)
+        self._mark_dirty(i, len(prices))
+
+    def __delitem__(self, price):
+        i = bisect_left(self.prices, price)
+        if i < len(self.prices) and self.prices[i] == price:
+            self._mark_dirty(i, len(self.prices))
+            del self.prices[i]
+            del self.volumes[i]
+            return
+        raise KeyError(price)
+
+    def __iter__(self):
+        return iter(self.prices)
+
+    def clear(self):
+        del self.prices[:]
+        del self.volumes[:]
+        self.dirty = 0
+
+    def peekitem(self, index=-1):
+        return self.prices[index], self.volumes[index]
+
+    def best(self):
+        if self.is_bids:
+            return self.peekitem(-1)
+        return self.peekitem(0)
+
+    def items(self):
+        return zip(self.prices, self.volumes)
+
+    def levels(self):
+        # 从最优价开始的 (价格, 数量)
+        if self.is_bids:
+            return zip(reversed(self.prices), reversed(self.volumes))
+        return zip(self.prices, self.volumes)
+
+    def _mark_dirty(self, i, length):
+        # i 是存储下标, 转成从最优价开始的下标
+        level = length - 1 - i if self.is_bids else i
+        if level < self.dirty:
+            self.dirty = level
+
+    def _refresh_cum(self, quote_num):
+        # 丢弃 dirty 之后的累计值, 再从 dirty 开始往深处补算, 累计金额达到 quote_num 就停止
+        # 只有最优价附近变化时, 每次只需要重算靠前的几档, 和深度无关
+        cum_volumes = self.cum_volumes
+        cum_notionals = self.cum_notionals
+        start = min(self.dirty, len(cum_notionals))
+        del cum_volumes[start:]
+        del cum_notionals[start:]
+        cum_volume = cum_volumes[-1] if start else 0.0
+        cum_notional = cum_notionals[-1] if start else 0.0
+        prices = self.prices
+        volumes = self.volumes
+        length = len(prices)
+        level = start
+        while level < length and cum_notional < quote_num:
+            i = length - 1 - level if self.is_bids else level
+            cum_volume += volumes[i]
+            cum_notional += prices[i] * volumes[i]
+            cum_volumes.append(cum_volume)
+            cum_notionals.append(cum_notional)
+            level += 1
+        self.dirty = level
+
+    def fill_by_quote(self, quote_num):
+        # 从最优价开始吃单, 累计金额达到 quote_num 时的 (最差价, 累计数量, 均价, 档位数)
+        # 深度不够时返回整个盘口
+        length = len(self.prices)
+        if length == 0:
+            return None
+        if self.dirty < len(self.cum_notionals) or not self.cum_notionals or self.cum_notionals[-1] < quote_num:
+            self._refresh_cum(quote_num)
+        level = bisect_left(self.cum_notionals, quote_num)
+        if level >= len(self.cum_notionals):
+            level = len(self.cum_notionals) - 1
+        price = self.prices[length - 1 - level] if self.is_bids else self.prices[level]
+        volume = self.cum_volumes[level]
+        return price, volume, self.cum_notionals[level] / volume, level + 1
+
+    def nbytes(self):
+        return (self.prices.buffer_info()[1] + self.volumes.buffer_info()[1]) * self.prices.itemsize
+
+
+def update_order_book(asks, bids, data):
+    if data['full']:
+        asks.clear()
+        bids.clear()
+    for item in data['asks']:
+        update_order_book_side(asks, item[0], item[1])
+    for item in data['bids']:
+        update_order_book_side(bids, item[0], item[1])
+
+
+def update_order_book_side(book_side, price, volume):
+    if volume == 0.0:
+        try:
+            del book_side[price]
+        except KeyError:
+            pass
+    else:
+        book_side[price] = volume
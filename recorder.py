@@ -0,0 +1,101 @@
+import json
+import mmap
+import time
+import atexit
+import struct
+from array import array
+
+# 文件格式:
+#   文件头: MAGIC, 元数据 json 长度 (uint32), 元数据 json, 补齐到 8 字节
+#   记录: RECORD_HEADER (时间戳, 数据流编号, 是否全量, asks 档数, bids 档数), 然后是 asks 和 bids 的 (价格, 数量) float64
+# 全部小端, 记录头 16 字节, 价格数量保持 8 字节对齐, 回放时可以直接 cast 成 double
+MAGIC = b'LEEKBOOK'
+META_LENGTH = struct.Struct('<I')
+RECORD_HEADER = struct.Struct('<dBBHHxx')
+
+RECORDERS = []
+
+
+class OrderBookRecorder(object):
+    def __init__(self, path, meta=None, buffer_size=1024 * 1024):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+        self.record_count = 0
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            meta_bytes = json.dumps(meta or {}).encode()
+            header = MAGIC + META_LENGTH.pack(len(meta_bytes)) + meta_bytes
+            header += b'\0' * (-len(header) % 8)
+            self.file.write(header)
+        RECORDERS.append(self)
+
+    def record(self, stream, data, ts=None):
+        asks = data['asks']
+        bids = data['bids']
+        self.buffer += RECORD_HEADER.pack(time.time() if ts is None else ts, stream, 1 if data['full'] else 0, len(asks), len(bids))
+        values = array('d')
+        for item in asks:
+            values.append(item[0])
+            values.append(item[1])
+        for item in bids:
+            values.append(item[0])
+            values.append(item[1])
+        self.buffer += values.tobytes()
+        self.record_count += 1
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(self.buffer)
+            self.file.flush()
+            self.buffer = bytearray()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+
+@atexit.register
+def close_recorders():
+    for item in RECORDERS:
+        item.close()
+
+
+def read_meta(buf):
+    if buf[:len(MAGIC)] != MAGIC:
+        raise RuntimeError("not a leek order book record file")
+    offset = len(MAGIC)
+    meta_length = META_LENGTH.unpack_from(buf, offset)[0]
+    offset += META_LENGTH.size
+    meta = json.loads(bytes(buf[offset:offset + meta_length]))
+    offset += meta_length
+    offset += -offset % 8
+    return meta, offset
+
+
+def read_records(path):
+    # 逐条返回 (时间戳, 数据流编号, 深度数据), 深度数据和 ws 回调的格式相同
+    with open(path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(buf)
+    try:
+        meta, offset = read_meta(view)
+        size = len(view)
+        while offset + RECORD_HEADER.size <= size:
+            ts, stream, full, ask_num, bid_num = RECORD_HEADER.unpack_from(view, offset)
+            offset += RECORD_HEADER.size
+            end = offset + (ask_num + bid_num) * 16
+            if end > size:
+                break  # 最后一条没写完整
+            values = view[offset:end].cast('d')
+            asks = list(zip(values[0:ask_num * 2:2], values[1:ask_num * 2:2]))
+            bids = list(zip(values[ask_num * 2::2], values[ask_num * 2 + 1::2]))
+            values.release()
+            offset = end
+            yield ts, stream, {'full': bool(full), 'asks': asks, 'bids': bids}
+    finally:
+        view.release()
+        buf.close()
@@ -0,0 +1,99 @@
+import asyncio
+from . import order_tracker
+from . import orderbook
+from . import recorder
+from . import scheduler
+from .base import ArbitrageConfig
+from .bricklayer import Bricklayer
+from .simexchange import SimExchange, SimMarket
+
+
+# 用 recorder 记录的深度数据驱动 Bricklayer, 交易所换成 SimExchange, 不等待真实时间
+class ReplayDriver(object):
+    def __init__(self, config, path, balances1=None, balances2=None):
+        self.path = path
+        self.bricklayer = Bricklayer(config)
+        # 模拟成交立即返回, 剩余的挂单不需要等待
+        config.order_timeout = 0
+        self.clock = 0.0
+        b = self.bricklayer
+        market1 = SimMarket(config.exchange1_id, config.symbol, b.exchange1_asks, b.exchange1_bids)
+        market2 = SimMarket(config.exchange2_id, config.symbol, b.exchange2_asks, b.exchange2_bids)
+        b.exchange1 = SimExchange(config.exchange1_id, {'apiKey': f'replay-{id(self)}', 'balances': balances1 or {},
+                                                        'default_balance': 0.0, 'taker_fee': config.exchange1_taker_fee},
+                                  market1, self.get_clock)
+        b.exchange2 = SimExchange(config.exchange2_id, {'apiKey': f'replay-{id(self)}', 'balances': balances2 or {},
+                                                        'default_balance': 0.0, 'taker_fee': config.exchange2_taker_fee},
+                                  market2, self.get_clock)
+        self.record_count = 0
+        self.error_count = 0
+        self.start_value = None
+        self.last_mid_price = None
+
+    def get_clock(self):
+        return self.clock
+
+    def _value(self):
+        # 按最后的中间价折算成报价币
+        config = self.bricklayer.config
+        value = 0.0
+        for exchange in (self.bricklayer.exchange1, self.bricklayer.exchange2):
+            value += exchange.balances.get(config.quote_coin, 0.0) + exchange.balances.get(config.base_coin, 0.0) * self.last_mid_price
+        return value
+
+    def _update_mid_price(self):
+        b = self.bricklayer
+        if b.exchange1_asks and b.exchange1_bids:
+            self.last_mid_price = (b.exchange1_asks.best()[0] + b.exchange1_bids.best()[0]) / 2
+
+    async def run(self):
+        b = self.bricklayer
+        try:
+            await b.update_balance()
+            for ts, stream, data in recorder.read_records(self.path):
+                self.clock = ts
+                self.record_count += 1
+                if stream == 1:
+                    orderbook.update_order_book(b.exchange1_asks, b.exchange1_bids, data)
+                else:
+                    orderbook.update_order_book(b.exchange2_asks, b.exchange2_bids, data)
+                if self.start_value is None:
+                    self._update_mid_price()
+                    if self.last_mid_price is not None:
+                        self.start_value = self._value()
+                try:
+                    await b.evaluate()
+                except Exception:
+                    self.error_count += 1
+            self._update_mid_price()
+        finally:
+            for exchange in (b.exchange1, b.exchange2):
+                scheduler.SCHEDULERS.pop((exchange.id, exchange.apiKey), None)
+                order_tracker.ORDER_TRACKERS.pop((exchange.id, exchange.apiKey), None)
+        return self.result()
+
+    def result(self):
+        b = self.bricklayer
+        end_value = self._value() if self.last_mid_price is not None else None
+        return {
+            'record_count': self.record_count,
+            'error_count': self.error_count,
+            'order_count': len(b.exchange1.orders) + len(b.exchange2.orders),
+            'start_value': self.start_value,
+            'end_value': end_value,
+            'profit': end_value - self.start_value if self.start_value is not None else None,
+            'balances1': dict(b.exchange1.balances),
+            'balances2': dict(b.exchange2.balances),
+        }
+
+
+def replay(options, path, balances1=None, balances2=None):
+    return asyncio.run(ReplayDriver(ArbitrageConfig(options), path, balances1, balances2).run())
+
+
+# 对一个参数取不同的值分别回放, 如 sweep(options, path, 'one_to_two_pure_profit_limit', [0.001, 0.002])
+def sweep(options, path, name, values, balances1=None, balances2=None):
+    results = []
+    for value in values:
+        results.append((value, replay(dict(options, **{name: value}), path, balances1, balances2)))
+    return results
@@ -0,0 +1,195 @@
+import time
+import asyncio
+import numpy as np
+from . import logutils
+from . import metrics
+from . import utils
+
+logger = logutils.get_logger('leek-scanner')
+
+# 第二维的两个方向: 0 exchange1 低买 exchange2 高卖, 1 exchange2 低买 exchange1 高卖
+DIRECTIONS = ('one_to_two', 'two_to_one')
+
+
+def get_fee_coefficients(bricklayer, ask_exchange, bid_exchange):
+    # 手续费率只和高卖价 p 有关, 形如 a + c / p (c 来自报价币提现费), 用两个价格解出 a 和 c
+    if bricklayer.config.enable_transfer:
+        get_fee_rate = bricklayer.get_cross_exchange_fee_rate
+    else:
+        get_fee_rate = bricklayer.get_exchange_fee_rate
+    fee1 = get_fee_rate(1.0, ask_exchange, bid_exchange)
+    fee2 = get_fee_rate(2.0, ask_exchange, bid_exchange)
+    c = (fee1 - fee2) * 2
+    return fee1 - c, c
+
+
+# 所有套利对的盘口放在 numpy 数组中, 每次深度变化只刷新变化的行, 再一次算出所有套利对两个方向的利润和可交易数量
+# 通过检查的行才交给 Bricklayer 原来的下单流程, 下单前仍会按最新深度和余额再检查一遍
+class OpportunityScanner(object):
+    def __init__(self, bricklayers):
+        self.bricklayers = list(bricklayers)
+        num = len(self.bricklayers)
+        self.dirty = set(range(num))
+        # 正在下单的行, 下单完成前不再计算
+        self.busy = set()
+        self.event = asyncio.Event()
+        self.scan_count = 0
+        self.accounts_refreshed_at = 0.0
+
+        # 形状 (套利对, 方向): 低买市场的吃单价和数量, 高卖市场的吃单价和数量
+        self.ask_prices = np.zeros((num, 2))
+        self.ask_nums = np.zeros((num, 2))
+        self.bid_prices = np.zeros((num, 2))
+        self.bid_nums = np.zeros((num, 2))
+        # 卖一买一, 用于检查同市场已有单会先成交; 没有深度时为 nan, 比较结果为 False
+        self.ask_tops = np.full((num, 2), np.nan)
+        self.ask_market_bid_tops = np.full((num, 2), np.nan)
+        self.bid_tops = np.full((num, 2), np.nan)
+        self.bid_market_ask_tops = np.full((num, 2), np.nan)
+        # 低买市场的报价币余额, 高卖市场的基本币余额, 两个市场挂单数的较大值
+        self.quote_balances = np.zeros((num, 2))
+        self.base_balances = np.zeros((num, 2))
+        self.open_order_nums = np.zeros(num)
+
+        # 不变的配置
+        self.fee_a = np.zeros((num, 2))
+        self.fee_c = np.zeros((num, 2))
+        self.profit_limits = np.zeros((num, 2))
+        self.min_quotes = np.zeros((num, 1))
+        self.max_quotes = np.zeros((num, 1))
+        self.max_open_orders = np.zeros(num)
+        for i, b in enumerate(self.bricklayers):
+            self.fee_a[i, 0], self.fee_c[i, 0] = get_fee_coefficients(b, b.exchange1, b.exchange2)
+            self.fee_a[i, 1], self.fee_c[i, 1] = get_fee_coefficients(b, b.exchange2, b.exchange1)
+            self.profit_limits[i] = (b.config.one_to_two_pure_profit_limit, b.config.two_to_one_pure_profit_limit)
+            self.min_quotes[i] = b.config.min_buy_num_limit_by_quote
+            self.max_quotes[i] = b.config.max_buy_num_limit_by_quote
+            self.max_open_orders[i] = b.config.max_open_order_limit
+
+    # update_order_book 之后调用, 深度变化时标记对应的行
+    def attach(self):
+        for i, b in enumerate(self.bricklayers):
+            b.exchange1_book.add_listener(self._get_ws_callback(i, b.exchange1_book))
+            b.exchange2_book.add_listener(self._get_ws_callback(i, b.exchange2_book))
+
+    def _get_ws_callback(self, index, book):
+        def callback(data):
+            # 深度交叉时不计算
+            if book.is_crossed():
+                return
+            self.dirty.add(index)
+            self.event.set()
+        return callback
+
+    def _refresh_row(self, i):
+        b = self.bricklayers[i]
+        ask1 = b.get_best_ask(b.exchange1_asks)
+        bid1 = b.get_best_bid(b.exchange1_bids)
+        ask2 = b.get_best_ask(b.exchange2_asks)
+        bid2 = b.get_best_bid(b.exchange2_bids)
+        self.ask_prices[i] = (ask1[0], ask2[0])
+        self.ask_nums[i] = (ask1[1], ask2[1])
+        self.bid_prices[i] = (bid2[0], bid1[0])
+        self.bid_nums[i] = (bid2[1], bid1[1])
+        ask1_top = b.get_last_ask(b.exchange1_asks)[0] if b.exchange1_asks else np.nan
+        bid1_top = b.get_last_bid(b.exchange1_bids)[0] if b.exchange1_bids else np.nan
+        ask2_top = b.get_last_ask(b.exchange2_asks)[0] if b.exchange2_asks else np.nan
+        bid2_top = b.get_last_bid(b.exchange2_bids)[0] if b.exchange2_bids else np.nan
+        self.ask_tops[i] = (ask1_top, ask2_top)
+        self.ask_market_bid_tops[i] = (bid1_top, bid2_top)
+        self.bid_tops[i] = (bid2_top, bid1_top)
+        self.bid_market_ask_tops[i] = (ask2_top, ask1_top)
+
+    def _refresh_account(self, i):
+        b = self.bricklayers[i]
+        self.quote_balances[i] = (b.exchange1_quote_coin_balance, b.exchange2_quote_coin_balance)
+        self.base_balances[i] = (b.exchange2_base_coin_balance, b.exchange1_base_coin_balance)
+        self.open_order_nums[i] = max(b.exchange1_open_order_num, b.exchange2_open_order_num)
+
+    # 返回 [(纯利润率, 行, 方向, 可交易数量)], 按纯利润率从高到低
+    def scan(self):
+        # 下单后的行会标记为变化, 余额随之刷新; 定时任务校对的余额和挂单数每秒全部刷新一次
+        now = time.time()
+        if now - self.accounts_refreshed_at >= 1:
+            self.accounts_refreshed_at = now
+            for i in range(len(self.bricklayers)):
+                self._refresh_account(i)
+        for i in self.dirty:
+            self._refresh_row(i)
+            self._refresh_account(i)
+        self.dirty.clear()
+        self.scan_count += 1
+
+        ask_prices = self.ask_prices
+        bid_prices = self.bid_prices
+        with np.errstate(divide='ignore', invalid='ignore'):
+            premium_rates = (bid_prices - ask_prices) / ask_prices
+            fee_rates = self.fee_a + self.fee_c / bid_prices
+            pure_profits = premium_rates - fee_rates
+            # 低买价比高卖价低, 所以最小交易数量按低买价计算
+            min_nums = self.min_quotes / ask_prices
+            max_buy_nums = self.quote_balances / ask_prices * 0.97
+            ok = ((ask_prices > 0) & (bid_prices > 0) & (ask_prices < bid_prices)
+                  & ~(self.ask_tops <= self.ask_market_bid_tops) & ~(self.bid_market_ask_tops <= self.bid_tops)
+                  & (self.open_order_nums < self.max_open_orders)[:, None]
+                  & (premium_rates > fee_rates) & (pure_profits > self.profit_limits)
+                  & (self.ask_nums >= min_nums) & (self.bid_nums >= self.min_quotes / bid_prices)
+                  & (max_buy_nums >= min_nums) & (self.base_balances >= min_nums))
+            rows, directions = np.nonzero(ok)
+            if len(rows) == 0:
+                return []
+            buy_nums = np.minimum(np.minimum(self.ask_nums, self.bid_nums), np.minimum(max_buy_nums, self.base_balances))
+            buy_nums = np.minimum(buy_nums, self.max_quotes / ask_prices)
+        result = [(pure_profits[i, d], i, d, buy_nums[i, d]) for i, d in zip(rows.tolist(), directions.tolist())]
+        result.sort(reverse=True)
+        return result
+
+    async def run(self):
+        self.attach()
+        while not utils.exit_signal:
+            try:
+                # 超时是为了能及时检查 exit_signal
+                await asyncio.wait_for(self.event.wait(), timeout=1)
+            except asyncio.TimeoutError:
+                pass
+            self.event.clear()
+            started_at = time.time()
+            candidates = self.scan()
+            metrics.histogram('leek_scan_seconds').observe(time.time() - started_at)
+            metrics.counter('leek_scan_candidates_total').inc(len(candidates))
+            for pure_profit, i, direction, buy_num in candidates:
+                if i in self.busy or self._is_suspended(i):
+                    continue
+                logger.debug("%s %s pure profit %s buy num %s", self.bricklayers[i].config.name, DIRECTIONS[direction], pure_profit, buy_num)
+                self.busy.add(i)
+                asyncio.create_task(self._trade(i, direction))
+        print("catch exit_signal")
+
+    def _is_suspended(self, i):
+        # 任一市场熔断或深度不可用时两个方向都不能下单, 恢复后深度不变也需要重新计算
+        b = self.bricklayers[i]
+        if b._get_unavailable_reason(b.exchange1, b.exchange2, time.time()) is not None:
+            self.dirty.add(i)
+            return True
+        return False
+
+    async def _trade(self, i, direction):
+        b = self.bricklayers[i]
+        try:
+            if direction == 0:
+                await b.evaluate_one_to_two()
+            else:
+                await b.evaluate_two_to_one()
+        except Exception as e:
+            await b._move_brick_exception(e)
+        finally:
+            self.busy.discard(i)
+            # 下单后深度已变, 下次计算时刷新; 不立即重算, 避免和下单流程的检查结果不一致时反复触发
+            self.dirty.add(i)
+
+
+# 代替 utils.run_all_bricklayers, 所有 Bricklayer 初始化后由一个 scanner 统一计算, 只支持两个市场的 Bricklayer
+async def run_all_bricklayers(bricklayer_list):
+    scanner = OpportunityScanner(bricklayer_list)
+    await asyncio.gather(utils.run_all_exchange_ws(bricklayer_list), *[bricklayer.start() for bricklayer in bricklayer_list])
+    await scanner.run()
@@ -0,0 +1,152 @@
+import os
+import asyncio
+import heapq
+import itertools
+import time
+import ccxt
+from . import alerts
+from . import breaker
+from . import logutils
+from . import metrics
+
+logger = logutils.get_logger('leek-scheduler')
+
+# 数值越小越先执行
+PRIORITY_TRADE = 0  # 下单, 撤单
+PRIORITY_ORDER_QUERY = 1  # 查询在途订单
+PRIORITY_REFRESH = 2  # 定时刷新余额, 挂单数
+
+# 所有 Bricklayer 共用, 同一个 (exchange_id, api_key) 一个调度器
+SCHEDULERS = {}
+
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    # 取一个令牌, 返回还需要等待的秒数, 0 表示已取到
+    def acquire(self):
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+# 同一个 API Key 同一时间只执行一个请求, 按优先级和提交顺序依次执行, 保证 nonce 递增 (poloniex 之类)
+# 不同 API Key 之间互不阻塞
+# 每个请求最多执行 timeout 秒, 超时和网络错误计入熔断器; 熔断期间请求直接失败, 不再排队等待
+# probe: 熔断后没有其他请求时, 到期用它试探交易所是否恢复
+class ApiScheduler(object):
+    def __init__(self, key, rate, capacity=5, timeout=None, probe=None, venue_breaker=None):
+        self.key = key
+        self.bucket = TokenBucket(rate, capacity)
+        self.timeout = timeout
+        self.probe = probe
+        self.breaker = venue_breaker or breaker.CircuitBreaker(key)
+        self.queue = []
+        self.counter = itertools.count()
+        self.task = None
+        self.probe_task = None
+        self.call_count = 0
+
+    async def call(self, priority, func, *args, **kwargs):
+        if not self.breaker.allow():
+            raise breaker.BreakerOpenError(f"{self.key[0]} breaker {self.breaker.state}, {func.__name__} rejected")
+        probe = self.breaker.state == breaker.HALF_OPEN
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.queue, (priority, next(self.counter), future, probe, func, args, kwargs))
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+        return await future
+
+    async def _run(self):
+        try:
+            while self.queue:
+                delay = self.bucket.acquire()
+                if delay > 0:
+                    # 等待期间可能有更高优先级的请求进来, 取到令牌后再出队
+                    await asyncio.sleep(delay)
+                    continue
+                priority, _, future, probe, func, args, kwargs = heapq.heappop(self.queue)
+                if future.done():
+                    if probe:
+                        self.breaker.cancel_probe()
+                    continue
+                self.call_count += 1
+                try:
+                    result = await self._execute(func, args, kwargs)
+                except Exception as e:
+                    self._record_failure(e)
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    self.breaker.record_success()
+                    if not future.done():
+                        future.set_result(result)
+        finally:
+            self.task = None
+
+    async def _execute(self, func, args, kwargs):
+        if self.timeout is None:
+            return await func(*args, **kwargs)
+        try:
+            return await asyncio.wait_for(func(*args, **kwargs), self.timeout)
+        except asyncio.TimeoutError:
+            metrics.counter('leek_api_timeouts_total', exchange=self.key[0], method=func.__name__).inc()
+            raise ccxt.RequestTimeout(f"{self.key[0]} {func.__name__} timed out after {self.timeout} seconds")
+
+    def _record_failure(self, e):
+        if not breaker.is_venue_failure(e):
+            # 交易所有正常响应
+            self.breaker.record_success()
+            return
+        if not self.breaker.record_failure():
+            return
+        alerts.get_notifier().notify(f"{self.key[0]} breaker open: {e}", {'name': self.key[0]}, key=(self.key[0], 'breaker'))
+        if self.probe is not None and self.probe_task is None:
+            self.probe_task = asyncio.create_task(self._probe())
+
+    async def _probe(self):
+        try:
+            while self.breaker.is_suspended():
+                await asyncio.sleep(max(self.breaker.retry_at - self.breaker.clock(), 0.1))
+                if self.breaker.state == breaker.OPEN and self.breaker.clock() < self.breaker.retry_at:
+                    continue
+                try:
+                    await self.call(PRIORITY_REFRESH, self.probe)
+                except Exception as e:
+                    logger.debug("%s probe failed %s", self.key[0], e)
+        finally:
+            self.probe_task = None
+
+
+def get_scheduler(exchange):
+    key = (exchange.id, exchange.apiKey)
+    if key not in SCHEDULERS:
+        # ccxt rateLimit 是两次请求之间的毫秒数
+        rate = 1000 / exchange.rateLimit if exchange.rateLimit else 0
+        SCHEDULERS[key] = ApiScheduler(key, rate, timeout=get_timeout(), probe=exchange.fetch_balance, venue_breaker=breaker.get_breaker(exchange))
+    return SCHEDULERS[key]
+
+
+def get_timeout():
+    # 秒, 0 不限制
+    timeout = float(os.environ.get('LEEK_API_TIMEOUT', 10))
+    return timeout if timeout > 0 else None
+
+
+async def call(exchange, priority, method, *args, **kwargs):
+    try:
+        return await get_scheduler(exchange).call(priority, getattr(exchange, method), *args, **kwargs)
+    except Exception as e:
+        # 记下出错的市场, Bricklayer 只暂停涉及它的套利方向
+        e.exchange_id = exchange.id
+        raise
@@ -0,0 +1,398 @@
+import time
+import random
+import asyncio
+import itertools
+import ccxt
+from . import orderbook
+from . import utils
+from . import scheduler
+
+# 交易所 id 为 sim 或以 sim_ 开头时, utils.get_exchange / get_exchange_ws 返回模拟交易所, 用于离线压测
+# 可以用 configure('sim_a', latency=('lognormal', -3, 0.5), partial_fill_rate=0.2) 配置每个模拟交易所
+DEFAULT_OPTIONS = {
+    'apiKey': 'sim',
+    'balances': {},
+    'default_balance': 1000.0,  # balances 中没有的币的初始余额
+    'taker_fee': 0.001,
+    'latency': None,  # 每次接口调用的延迟秒数: None, ('const', s), ('uniform', a, b), ('exp', mean), ('lognormal', mu, sigma) 或函数
+    'partial_fill_rate': 0.0,  # 下单时只成交一部分的概率, 剩余部分挂单, 之后按深度继续撮合
+    'rate_limit': 0,  # 每秒最多请求数, 超出抛 ccxt.RateLimitExceeded, 0 不限制
+    'rateLimit': 0,  # 同 ccxt, 两次请求间隔毫秒数, 给 scheduler 使用
+    'seed': None,
+    # 行情
+    'mid_price': 100.0,
+    'tick': 0.01,
+    'levels': 20,
+    'spread': 0.001,  # 买一卖一价差比例
+    'volatility': 0.0005,  # 同一交易对公共中间价每步波动比例
+    'divergence': 0.002,  # 每个市场偏离公共中间价的波动比例
+    'ws_interval': 0.1,  # ws 推送间隔秒数
+    'ws_drop_rate': 0.0,  # ws 增量消息丢失的概率, 用于测试断档后重新同步
+}
+
+SIM_OPTIONS = {}
+SIM_MARKETS = {}
+# (exchange_id, apiKey) -> SimAccount, utils.get_exchange 创建的同一账户的实例共用余额和订单, 和真实交易所一样
+SIM_ACCOUNTS = {}
+# 同一交易对的公共中间价, 各模拟市场围绕它波动, 所以市场之间会出现价差
+SIM_MID_PRICES = {}
+
+
+def is_sim_exchange(exchange_id):
+    return exchange_id == 'sim' or exchange_id.startswith('sim_')
+
+
+def configure(exchange_id, **options):
+    SIM_OPTIONS.setdefault(exchange_id, {}).update(options)
+
+
+def get_options(exchange_id, options=None):
+    result = dict(DEFAULT_OPTIONS)
+    result.update(SIM_OPTIONS.get(exchange_id, {}))
+    result.update(options or {})
+    return result
+
+
+def get_latency_func(spec, rnd):
+    if spec is None:
+        return lambda: 0.0
+    if callable(spec):
+        return spec
+    kind = spec[0]
+    if kind == 'const':
+        return lambda: spec[1]
+    if kind == 'uniform':
+        return lambda: rnd.uniform(spec[1], spec[2])
+    if kind == 'exp':
+        return lambda: rnd.expovariate(1 / spec[1])
+    if kind == 'lognormal':
+        return lambda: rnd.lognormvariate(spec[1], spec[2])
+    raise RuntimeError(f"unknown latency {spec}")
+
+
+# 一个模拟交易所一个交易对的撮合深度, ws 推送和下单撮合共用
+class SimMarket(object):
+    def __init__(self, exchange_id, symbol, asks=None, bids=None, options=None):
+        self.exchange_id = exchange_id
+        self.symbol = symbol
+        self.options = get_options(exchange_id, options)
+        self.rnd = random.Random(self.options['seed'])
+        self.asks = asks if asks is not None else orderbook.OrderBookSide(max_depth=self.options['levels'] * 2)
+        self.bids = bids if bids is not None else orderbook.OrderBookSide(is_bids=True, max_depth=self.options['levels'] * 2)
+        self.offset = 0.0
+        # 上次推送后变化的档位, price -> volume, 0 为删除
+        self.ask_changes = {}
+        self.bid_changes = {}
+        # ws 消息序号, 每次增量加一
+        self.seq = 0
+
+    def _set_level(self, book_side, changes, price, volume):
+        orderbook.update_order_book_side(book_side, price, volume)
+        changes[price] = volume
+
+    def step(self):
+        options = self.options
+        mid_price = SIM_MID_PRICES.get(self.symbol, options['mid_price'])
+        mid_price *= 1 + self.rnd.gauss(0, options['volatility'])
+        SIM_MID_PRICES[self.symbol] = mid_price
+        # 偏离均值回归
+        self.offset = self.offset * 0.9 + self.rnd.gauss(0, options['divergence'])
+        mid_price *= 1 + self.offset
+        tick = options['tick']
+        half_spread = max(mid_price * options['spread'] / 2, tick)
+        best_ask = round((mid_price + half_spread) / tick) * tick
+        best_bid = round((mid_price - half_spread) / tick) * tick
+        ask_prices = set(round(best_ask + i * tick, 10) for i in range(options['levels']))
+        bid_prices = set(round(best_bid - i * tick, 10) for i in range(options['levels']))
+        for book_side, changes, prices in ((self.asks, self.ask_changes, ask_prices), (self.bids, self.bid_changes, bid_prices)):
+            for price in list(book_side):
+                if price not in prices:
+                    self._set_level(book_side, changes, price, 0.0)
+            for price in prices:
+                if price not in book_side or self.rnd.random() < 0.2:
+                    self._set_level(book_side, changes, price, round(self.rnd.uniform(0.01, 10.0), 4))
+
+    def snapshot(self):
+        self.ask_changes.clear()
+        self.bid_changes.clear()
+        return {'full': True, 'asks': [list(item) for item in self.asks.items()], 'bids': [list(item) for item in self.bids.items()],
+                'seq': self.seq}
+
+    def pop_delta(self):
+        self.seq += 1
+        data = {'full': False, 'asks': [[price, volume] for price, volume in self.ask_changes.items()],
+                'bids': [[price, volume] for price, volume in self.bid_changes.items()], 'seq': self.seq}
+        self.ask_changes.clear()
+        self.bid_changes.clear()
+        return data
+
+    def match(self, side, amount, price):
+        # 吃单, 返回 (成交数量, 成交金额)
+        book_side, changes = (self.asks, self.ask_changes) if side == 'buy' else (self.bids, self.bid_changes)
+        filled = 0.0
+        cost = 0.0
+        while filled < amount and book_side:
+            level_price, level_volume = book_side.best()
+            if (side == 'buy' and level_price > price) or (side == 'sell' and level_price < price):
+                break
+            num = min(amount - filled, level_volume)
+            filled += num
+            cost += num * level_price
+            self._set_level(book_side, changes, level_price, level_volume - num if num < level_volume else 0.0)
+        return filled, cost
+
+
+def get_market(exchange_id, symbol):
+    key = (exchange_id, symbol)
+    if key not in SIM_MARKETS:
+        market = SimMarket(exchange_id, symbol)
+        market.step()
+        SIM_MARKETS[key] = market
+    return SIM_MARKETS[key]
+
+
+class SimAccount(object):
+    def __init__(self, balances):
+        self.balances = dict(balances)
+        self.orders = {}
+        self.order_ids = itertools.count(1)
+
+
+def get_account(exchange_id, options=None):
+    options = get_options(exchange_id, options)
+    key = (exchange_id, options['apiKey'])
+    if key not in SIM_ACCOUNTS:
+        SIM_ACCOUNTS[key] = SimAccount(options['balances'])
+    return SIM_ACCOUNTS[key]
+
+
+# 没有动过的币余额都是 default_balance, 所以查询任何币都有余额, 启动时还没有 SimMarket 也能拿到交易对两个币的余额
+class SimBalance(dict):
+    def __init__(self, exchange, coins):
+        super().__init__()
+        self.exchange = exchange
+        for coin in coins:
+            self[coin]
+
+    def __contains__(self, coin):
+        return True
+
+    def __missing__(self, coin):
+        num = self.exchange._get_balance(coin)
+        item = {'free': num, 'used': 0.0, 'total': num}
+        self[coin] = item
+        return item
+
+
+# 模拟 ccxt 交易所, 只实现 Bricklayer 用到的接口
+# 限价单下单时按市场深度撮合, 吃掉的数量从深度中扣除, 没成交的部分挂单, 之后查询时继续撮合
+class SimExchange(object):
+    # account 为 None 时使用独立的账户 (replay, 压测)
+    def __init__(self, exchange_id, options=None, market=None, clock=time.time, account=None):
+        options = get_options(exchange_id, options)
+        self.id = exchange_id
+        self.options = options
+        self.apiKey = options['apiKey']
+        self.rateLimit = options['rateLimit']
+        self.has = {
+            'fetchBalance': True,
+            'fetchOpenOrders': True,
+            'fetchOrder': True,
+            'fetchOrderBook': True,
+            'createOrder': True,
+            'cancelOrder': True,
+        }
+        self.market = market
+        if account is None:
+            account = SimAccount(options['balances'])
+        self.account = account
+        self.balances = account.balances
+        self.taker_fee = options['taker_fee']
+        self.partial_fill_rate = options['partial_fill_rate']
+        self.rnd = random.Random(options['seed'])
+        self.latency = get_latency_func(options['latency'], self.rnd)
+        self.bucket = scheduler.TokenBucket(options['rate_limit'], options['rate_limit']) if options['rate_limit'] else None
+        self.clock = clock
+        self.markets = {}
+        self.currencies = {}
+        self.orders = account.orders
+        self.request_count = 0
+        self.rate_limited_count = 0
+
+    def checkRequiredCredentials(self):
+        return True
+
+    def _get_market(self, symbol):
+        if self.market is not None:
+            return self.market
+        return get_market(self.id, symbol)
+
+    async def _request(self):
+        self.request_count += 1
+        if self.bucket is not None and self.bucket.acquire() > 0:
+            self.rate_limited_count += 1
+            raise ccxt.RateLimitExceeded(f"{self.id} rate limit exceeded")
+        delay = self.latency()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _get_balance(self, coin):
+        if coin not in self.balances:
+            self.balances[coin] = self.options['default_balance']
+        return self.balances[coin]
+
+    def _add_balance(self, coin, num):
+        self.balances[coin] = self._get_balance(coin) + num
+
+    async def load_markets(self, reload=False):
+        await self._request()
+        return self.markets
+
+    def set_markets(self, markets, currencies=None):
+        self.markets = markets
+        if currencies is not None:
+            self.currencies = currencies
+        return self.markets
+
+    async def fetch_balance(self):
+        await self._request()
+        self._fill_open_orders()
+        coins = set(self.balances)
+        if self.market is not None:
+            coins.update(self.market.symbol.split('/'))
+        for exchange_id, symbol in SIM_MARKETS:
+            if exchange_id == self.id:
+                coins.update(symbol.split('/'))
+        return SimBalance(self, coins)
+
+    async def fetch_order_book(self, symbol, limit=None):
+        await self._request()
+        market = self._get_market(symbol)
+        asks = list(market.asks.items())
+        bids = list(market.bids.items())[::-1]
+        if limit is not None:
+            asks = asks[:limit]
+            bids = bids[:limit]
+        return {'symbol': symbol, 'asks': [list(item) for item in asks], 'bids': [list(item) for item in bids],
+                'timestamp': int(self.clock() * 1000), 'nonce': market.seq}
+
+    async def fetch_open_orders(self, symbol=None):
+        await self._request()
+        self._fill_open_orders()
+        return [dict(order) for order in self.orders.values()
+                if order['status'] == 'open' and (symbol is None or order['symbol'] == symbol)]
+
+    async def fetch_order(self, order_id, symbol=None):
+        await self._request()
+        if order_id not in self.orders:
+            raise ccxt.OrderNotFound(f"{self.id} order {order_id} not found")
+        self._fill_open_orders()
+        return dict(self.orders[order_id])
+
+    async def create_limit_buy_order(self, symbol, amount, price):
+        await self._request()
+        return self._create_order(symbol, 'buy', amount, price)
+
+    async def create_limit_sell_order(self, symbol, amount, price):
+        await self._request()
+        return self._create_order(symbol, 'sell', amount, price)
+
+    async def cancel_order(self, order_id, symbol=None):
+        await self._request()
+        if order_id not in self.orders:
+            raise ccxt.OrderNotFound(f"{self.id} order {order_id} not found")
+        order = self.orders[order_id]
+        if order['status'] == 'open':
+            order['status'] = 'canceled'
+            self._unlock(order)
+        return dict(order)
+
+    def _create_order(self, symbol, side, amount, price):
+        base_coin, quote_coin = symbol.split('/')
+        # 下单先冻结全部数量, 成交后再结算
+        if side == 'buy':
+            self._add_balance(quote_coin, -amount * price)
+        else:
+            self._add_balance(base_coin, -amount)
+        order = {
+            'id': str(next(self.account.order_ids)),
+            'timestamp': int(self.clock() * 1000),
+            'symbol': symbol,
+            'type': 'limit',
+            'side': side,
+            'price': price,
+            'amount': amount,
+            'filled': 0.0,
+            'remaining': amount,
+            'cost': 0.0,
+            'average': None,
+            'status': 'open',
+        }
+        self.orders[order['id']] = order
+        max_num = amount
+        if self.partial_fill_rate > 0 and self.rnd.random() < self.partial_fill_rate:
+            max_num = amount * self.rnd.random()
+        self._fill_order(order, max_num)
+        return dict(order)
+
+    def _fill_order(self, order, max_num):
+        filled, cost = self._get_market(order['symbol']).match(order['side'], min(max_num, order['remaining']), order['price'])
+        if filled <= 0:
+            return
+        base_coin, quote_coin = order['symbol'].split('/')
+        if order['side'] == 'buy':
+            self._add_balance(base_coin, filled * (1 - self.taker_fee))
+            # 冻结按限价, 成交价更低时退回差额
+            self._add_balance(quote_coin, filled * order['price'] - cost)
+        else:
+            self._add_balance(quote_coin, cost * (1 - self.taker_fee))
+        order['filled'] += filled
+        order['remaining'] = order['amount'] - order['filled']
+        order['cost'] += cost
+        order['average'] = order['cost'] / order['filled']
+        if order['remaining'] <= order['amount'] * 1e-12:
+            order['remaining'] = 0.0
+            order['status'] = 'closed'
+
+    def _fill_open_orders(self):
+        for order in self.orders.values():
+            if order['status'] == 'open':
+                self._fill_order(order, order['remaining'])
+
+    def _unlock(self, order):
+        base_coin, quote_coin = order['symbol'].split('/')
+        if order['side'] == 'buy':
+            self._add_balance(quote_coin, order['remaining'] * order['price'])
+        else:
+            self._add_balance(base_coin, order['remaining'])
+
+
+class SimObserver(object):
+    def __init__(self, exchange, symbol, callback):
+        self.exchange = exchange
+        self.symbol = symbol
+        self.callback = callback
+
+
+# 模拟 ccxtws 交易所, 按 ws_interval 推送 SimMarket 的深度变化
+class SimExchangeWs(object):
+    def __init__(self, exchange_id='sim'):
+        self.exchange_id = exchange_id
+        self.observers = []
+        self.interval = get_options(exchange_id)['ws_interval']
+
+    def subscribe(self, observer):
+        self.observers.append(observer)
+
+    async def run(self):
+        for observer in self.observers:
+            observer.callback(get_market(observer.exchange.id, observer.symbol).snapshot())
+        while not utils.exit_signal:
+            await asyncio.sleep(self.interval)
+            for observer in self.observers:
+                market = get_market(observer.exchange.id, observer.symbol)
+                market.step()
+                data = market.pop_delta()
+                if market.options['ws_drop_rate'] and market.rnd.random() < market.options['ws_drop_rate']:
+                    continue
+                observer.callback(data)
@@ -0,0 +1,75 @@
+# 同时从低买市场的 asks 和高卖市场的 bids 最优价开始往深处走, 一次遍历两边的档位
+# asks 价格越来越高, bids 价格越来越低, 每一段的纯利润率单调下降, 只要大于 0 总利润就还在增加;
+# 平均纯利润率也随之下降, 所以一直走到边际纯利润率不大于 0 或平均纯利润率降到限值为止, 即是满足限值时总利润最大的数量
+
+
+def optimize_size(asks, bids, fee_rate, profit_limit, max_num, max_cost):
+    # fee_rate 按买入金额计算, 与 get_exchange_fee_rate/get_cross_exchange_fee_rate 一致
+    # max_num 为最多卖出的币数, max_cost 为最多买入的金额; 买单按吃到的最差档一次下单, 交易所按限价冻结, 所以按 num * 最差价 计算
+    # 返回 None 或 dict: 数量, 买卖两单的限价 (吃到的最差档), 均价, 每档成交, 预计利润
+    ask_levels = asks.levels()
+    bid_levels = bids.levels()
+    ask = next(ask_levels, None)
+    bid = next(bid_levels, None)
+    if ask is None or bid is None:
+        return None
+    ask_price, ask_remain = ask
+    bid_price, bid_remain = bid
+    num = 0.0
+    cost = 0.0
+    revenue = 0.0
+    buy_levels = []
+    sell_levels = []
+    while True:
+        rate = (bid_price - ask_price) / ask_price - fee_rate
+        profit = revenue - cost - cost * fee_rate
+        if rate <= 0 or (rate <= profit_limit and profit <= profit_limit * cost):
+            break
+        step = min(ask_remain, bid_remain, max_num - num, (max_cost - num * ask_price) / ask_price)
+        # 这一段拉低平均纯利润率, 最多吃到平均纯利润率正好等于限值
+        limit_step = None
+        if rate < profit_limit:
+            limit_step = (profit - profit_limit * cost) / (ask_price * (profit_limit - rate))
+            step = min(step, limit_step)
+        if step <= 0:
+            break
+        num += step
+        cost += step * ask_price
+        revenue += step * bid_price
+        _add_level(buy_levels, ask_price, step)
+        _add_level(sell_levels, bid_price, step)
+        ask_remain -= step
+        bid_remain -= step
+        if step == limit_step:
+            break
+        if ask_remain <= 0:
+            ask = next(ask_levels, None)
+            if ask is None:
+                break
+            ask_price, ask_remain = ask
+        if bid_remain <= 0:
+            bid = next(bid_levels, None)
+            if bid is None:
+                break
+            bid_price, bid_remain = bid
+    if num <= 0:
+        return None
+    profit = revenue - cost - cost * fee_rate
+    return {
+        'num': num,
+        'buy_price': buy_levels[-1][0],
+        'sell_price': sell_levels[-1][0],
+        'buy_vwap': cost / num,
+        'sell_vwap': revenue / num,
+        'buy_levels': buy_levels,
+        'sell_levels': sell_levels,
+        'profit': profit,
+        'profit_rate': profit / cost,
+    }
+
+
+def _add_level(levels, price, num):
+    if levels and levels[-1][0] == price:
+        levels[-1][1] += num
+    else:
+        levels.append([price, num])
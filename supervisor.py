@@ -0,0 +1,310 @@
+import os
+import time
+import signal
+import asyncio
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from . import alerts
+from . import bookstore
+from . import logutils
+from . import scanner
+from . import utils
+from .base import ArbitrageConfig, MultiArbitrageConfig
+from .bricklayer import Bricklayer
+from .multi_bricklayer import MultiBricklayer
+
+logger = logutils.get_logger('leek-supervisor')
+
+# 卖一价, 卖一量, 买一价, 买一量, 更新时间
+TOP_FIELDS = 5
+
+
+# 每个 (交易所, 交易对) 一个槽, 槽为 seq (int64) 和 TOP_FIELDS 个 float64, 放在 shared_memory 中供其他进程读取
+# seqlock: 写入前 seq 加一变成奇数, 写完再加一; 读取时 seq 为奇数或读前读后不一致则重读
+class TopOfBookTable(object):
+    def __init__(self, keys, name=None, create=False):
+        self.keys = [tuple(key) for key in keys]
+        self.slots = {key: i for i, key in enumerate(self.keys)}
+        num = len(self.keys)
+        if create:
+            self.shm = shared_memory.SharedMemory(create=True, size=max(num, 1) * 8 * (1 + TOP_FIELDS))
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.seqs = np.ndarray((num,), dtype=np.int64, buffer=self.shm.buf)
+        self.values = np.ndarray((num, TOP_FIELDS), dtype=np.float64, buffer=self.shm.buf, offset=num * 8)
+        if create:
+            self.seqs[:] = 0
+            self.values[:] = np.nan
+
+    def publish(self, slot, book):
+        ask = book.asks.best() if book.asks else (np.nan, np.nan)
+        bid = book.bids.best() if book.bids else (np.nan, np.nan)
+        self.seqs[slot] += 1
+        self.values[slot] = (ask[0], ask[1], bid[0], bid[1], book.updated_at or np.nan)
+        self.seqs[slot] += 1
+
+    def read(self, slot, retry=100):
+        for _ in range(retry):
+            seq = self.seqs[slot]
+            if seq & 1:
+                continue
+            values = self.values[slot].copy()
+            if self.seqs[slot] == seq:
+                return values
+        return None
+
+    # 返回 (卖一价, 卖一量, 买一价, 买一量, 更新时间), 还没有数据时返回 None
+    def get(self, exchange_id, symbol):
+        values = self.read(self.slots[(exchange_id, symbol)])
+        if values is None or np.isnan(values[4]):
+            return None
+        return tuple(values.tolist())
+
+    # 本进程 bookstore 中的深度更新后写入对应的槽
+    def attach(self, order_books):
+        for key, book in order_books.items():
+            slot = self.slots.get(key)
+            if slot is not None:
+                book.add_listener(self._get_publish_callback(slot, book))
+
+    def _get_publish_callback(self, slot, book):
+        def callback(data):
+            self.publish(slot, book)
+        return callback
+
+    def close(self, unlink=False):
+        # numpy 数组引用着共享内存, 先释放才能 close
+        self.seqs = None
+        self.values = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def is_multi_options(options):
+    return 'exchanges' in options
+
+
+def get_exchange_ids(options):
+    if is_multi_options(options):
+        return [venue['id'] for venue in options['exchanges']]
+    return [options['exchange1_id'], options['exchange2_id']]
+
+
+def get_shard_key(options, shard_by):
+    if shard_by == 'symbol':
+        return get_symbol(options)
+    if shard_by == 'exchange':
+        return tuple(sorted(get_exchange_ids(options)))
+    raise RuntimeError(f"unknown shard_by {shard_by}")
+
+
+def get_symbol(options):
+    return f"{options['base_coin']}/{options['quote_coin']}"
+
+
+def get_api_keys(options):
+    if is_multi_options(options):
+        return [(venue['id'], venue['api_key']) for venue in options['exchanges']]
+    return [(options['exchange1_id'], options['exchange1_api_key']), (options['exchange2_id'], options['exchange2_api_key'])]
+
+
+# 套利对用到的深度和账户: 同一份深度只能由一个进程写入共享内存 (seqlock 只支持一个写入者),
+# 同一个 API Key 的请求顺序 (scheduler) 和余额 (ledger) 只在一个进程内有效
+def get_resources(options):
+    symbol = get_symbol(options)
+    return [('book', exchange_id, symbol) for exchange_id in get_exchange_ids(options)] + \
+        [('account', exchange_id, api_key) for exchange_id, api_key in get_api_keys(options)]
+
+
+# 同一个 key 的套利对放在同一个进程, 共用 ws 和深度; 用到同一份深度或同一个 API Key 的分组也合并到同一个进程
+# 按套利对数量分给最空闲的进程
+def shard(options_list, worker_num, shard_by='symbol'):
+    parents = {}
+
+    def find(item):
+        while parents[item] != item:
+            parents[item] = parents[parents[item]]
+            item = parents[item]
+        return item
+
+    for options in options_list:
+        keys = [('shard', get_shard_key(options, shard_by))] + get_resources(options)
+        for key in keys:
+            parents.setdefault(key, key)
+        root = find(keys[0])
+        for key in keys[1:]:
+            parents[find(key)] = root
+    groups = {}
+    for options in options_list:
+        groups.setdefault(find(('shard', get_shard_key(options, shard_by))), []).append(options)
+    shards = [[] for _ in range(worker_num)]
+    for key in sorted(groups, key=lambda item: (-len(groups[item]), str(item))):
+        index = min(range(worker_num), key=lambda i: len(shards[i]))
+        shards[index].extend(groups[key])
+    return [item for item in shards if item]
+
+
+def get_book_keys(options_list):
+    keys = set()
+    for options in options_list:
+        symbol = get_symbol(options)
+        for exchange_id in get_exchange_ids(options):
+            keys.add((exchange_id, symbol))
+    return sorted(keys)
+
+
+def get_worker_env(index):
+    # 每个子进程单独的日志文件, 交易日志和 metrics 端口
+    env = {'APP_LOG_PATH': os.path.join(os.environ.get('APP_LOG_PATH', '/tmp/'), f'worker{index}-')}
+    journal_path = os.environ.get('LEEK_JOURNAL_PATH')
+    if journal_path:
+        env['LEEK_JOURNAL_PATH'] = journal_path + f'worker{index}-'
+    port = os.environ.get('LEEK_METRICS_PORT')
+    if port:
+        env['LEEK_METRICS_PORT'] = str(int(port) + index + 1)
+    return env
+
+
+async def _watch_exit(exit_event):
+    while not exit_event.is_set():
+        await asyncio.sleep(0.5)
+    utils.exit_signal = True
+
+
+async def _run_worker(bricklayers, table, exit_event, use_scanner):
+    asyncio.create_task(_watch_exit(exit_event))
+    await asyncio.gather(utils.run_all_exchange_ws(bricklayers), *[bricklayer.start() for bricklayer in bricklayers])
+    table.attach(bookstore.ORDER_BOOKS)
+    if use_scanner:
+        # scanner 只支持两个市场的 Bricklayer, 多市场的仍各自计算
+        pairs = [bricklayer for bricklayer in bricklayers if not isinstance(bricklayer, MultiBricklayer)]
+        tasks = [bricklayer.move_brick() for bricklayer in bricklayers if isinstance(bricklayer, MultiBricklayer)]
+        await asyncio.gather(scanner.OpportunityScanner(pairs).run(), *tasks)
+    else:
+        await asyncio.gather(*[bricklayer.move_brick() for bricklayer in bricklayers])
+
+
+def _worker_main(options_list, keys, table_name, exit_event, alert_queue, use_scanner, initializer, initargs):
+    # 退出由主进程通过 exit_event 通知
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    alerts.set_backend(alerts.QueueBackend(alert_queue))
+    if initializer is not None:
+        initializer(*initargs)
+    table = TopOfBookTable(keys, table_name)
+    bricklayers = []
+    for options in options_list:
+        if is_multi_options(options):
+            bricklayers.append(MultiBricklayer(MultiArbitrageConfig(options)))
+        else:
+            bricklayers.append(Bricklayer(ArbitrageConfig(options)))
+    try:
+        asyncio.run(_run_worker(bricklayers, table, exit_event, use_scanner))
+    finally:
+        table.close()
+
+
+# 按交易对或交易所把套利对分到多个子进程, 主进程负责退出信号, 提醒和子进程重启
+# initializer(*initargs) 在子进程创建 Bricklayer 之前调用
+class Supervisor(object):
+    def __init__(self, options_list, worker_num=None, shard_by='symbol', use_scanner=False, initializer=None, initargs=()):
+        self.worker_num = worker_num or os.cpu_count()
+        self.shards = shard(options_list, self.worker_num, shard_by)
+        self.keys = get_book_keys(options_list)
+        self.use_scanner = use_scanner
+        self.initializer = initializer
+        self.initargs = initargs
+        self.context = multiprocessing.get_context('spawn')
+        self.exit_event = self.context.Event()
+        self.alert_queue = self.context.Queue()
+        self.alert_thread = None
+        self.table = None
+        self.processes = []
+        self.restart_count = 0
+
+    def start(self):
+        self.table = TopOfBookTable(self.keys, create=True)
+        self.alert_thread = threading.Thread(target=self._forward_alerts, name='leek-supervisor-alerts', daemon=True)
+        self.alert_thread.start()
+        self.processes = [self._start_worker(index) for index in range(len(self.shards))]
+
+    def _start_worker(self, index):
+        process = self.context.Process(target=_worker_main, name=f'leek-worker-{index}',
+                                       args=(self.shards[index], self.keys, self.table.name, self.exit_event, self.alert_queue,
+                                             self.use_scanner, self.initializer, self.initargs))
+        # spawn 的子进程在启动时复制环境变量
+        env = get_worker_env(index)
+        old_env = {key: os.environ.get(key) for key in env}
+        os.environ.update(env)
+        try:
+            process.start()
+        finally:
+            for key, value in old_env.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+        logger.info("worker %s pid %s pairs %s", index, process.pid, len(self.shards[index]))
+        return process
+
+    def _forward_alerts(self):
+        while True:
+            item = self.alert_queue.get()
+            if item is None:
+                break
+            alerts.get_notifier().notify(item[0], item[1])
+
+    def stop(self):
+        utils.exit_signal = True
+        self.exit_event.set()
+
+    def _signal_handler(self, signum, frame):
+        utils.exit_signal_count += 1
+        self.stop()
+        if utils.exit_signal_count > 1:
+            for process in self.processes:
+                if process.is_alive():
+                    process.terminate()
+
+    def get_top(self, exchange_id, symbol):
+        return self.table.get(exchange_id, symbol)
+
+    def run(self):
+        signal.signal(signal.SIGINT, self._signal_handler)
+        signal.signal(signal.SIGTERM, self._signal_handler)
+        self.start()
+        try:
+            while any(process.is_alive() for process in self.processes):
+                if not self.exit_event.is_set():
+                    self._restart_dead_workers()
+                time.sleep(1)
+        finally:
+            self.close()
+
+    def _restart_dead_workers(self):
+        for index, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            msg = f"leek worker {index} exited with code {process.exitcode}, restarting"
+            logger.error(msg)
+            alerts.get_notifier().notify(msg, {'name': process.name})
+            self.restart_count += 1
+            self.processes[index] = self._start_worker(index)
+
+    def close(self, timeout=10):
+        self.stop()
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self.alert_queue.put(None)
+        if self.alert_thread is not None:
+            self.alert_thread.join(timeout)
+        if self.table is not None:
+            self.table.close(unlink=True)
+            self.table = None
@@ -4,6 +4,7 @@ import ccxt.async_support as asyncccxt
 import ccxt
 import ccxtws
 import pybrake
+from . import simexchange
 
 
 exit_signal = False
@@ -31,7 +32,9 @@ def get_exchange(exchange_id, options=None):
     if options is None:
         options = get_exchange_options(exchange_id)
     exchange = None
-    if exchange_id in asyncccxt.exchanges:
+    if simexchange.is_sim_exchange(exchange_id):
+        exchange = simexchange.SimExchange(exchange_id, options, account=simexchange.get_account(exchange_id, options))
+    elif exchange_id in asyncccxt.exchanges:
         exchange = getattr(asyncccxt, exchange_id)(options)
     else:
         raise
@@ -49,23 +52,35 @@ def get_exchange_sync(exchange_id, options=None):
     return exchange
 
 
+def _new_exchange_ws(exchange_id):
+    if simexchange.is_sim_exchange(exchange_id):
+        return simexchange.SimExchangeWs(exchange_id)
+    return getattr(ccxtws, exchange_id)()
+
+
 def get_exchange_ws(exchange_id, newobj=None):
     if newobj:
-        exchange_ws = getattr(ccxtws, exchange_id)()
+        exchange_ws = _new_exchange_ws(exchange_id)
         NEW_EXCHANGE_WSS.append(exchange_ws)
         return exchange_ws
     if exchange_id in EXCHANGE_WSS:
         return EXCHANGE_WSS[exchange_id]
-    exchange_ws = getattr(ccxtws, exchange_id)()
+    exchange_ws = _new_exchange_ws(exchange_id)
     EXCHANGE_WSS[exchange_id] = exchange_ws
     return exchange_ws
 
 
+def get_exchange_observer(exchange, symbol, callback):
+    if simexchange.is_sim_exchange(exchange.id):
+        return simexchange.SimObserver(exchange, symbol, callback)
+    return getattr(ccxtws, f'{exchange.id}_observer')(exchange, symbol, callback)
+
+
 async def run_all_exchange_ws(bricklayer_list):
     while True:
         if all([bricklayer.is_ready for bricklayer in bricklayer_list]):
             break
-        await asyncio.sleep(1)
+        await asyncio.sleep(0.1)
     print("all ready!")
     for exchange_id, exchange_ws in EXCHANGE_WSS.items():
         asyncio.create_task(exchange_ws.run())
@@ -73,6 +88,11 @@ async def run_all_exchange_ws(bricklayer_list):
         asyncio.create_task(exchange_ws.run())
 
 
+# 所有 Bricklayer 同时启动, 都完成初始化后再连接 ws
+async def run_all_bricklayers(bricklayer_list):
+    await asyncio.gather(run_all_exchange_ws(bricklayer_list), *[bricklayer.run() for bricklayer in bricklayer_list])
+
+
 def get_airbrake_notifier():
     return pybrake.Notifier(
         project_id=os.environ.get('AIRBRAKE_PROJECT_ID'),